@@ -1,35 +1,84 @@
 # -*- coding: utf-8 -*-
 import argparse
 import atexit
+import base64
+import collections
+import csv
 import datetime
+import glob
+import gzip
+import hashlib
+import heapq
+import hmac
 import inspect
 import json
 import logging
+import math
 import os
 import platform
+import random
 import re
 import shutil
 import socket
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
+from xml.sax.saxutils import escape, quoteattr
 
 try:
     import lsb_release
 except ImportError:
     pass
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    # For Python 3.0 and later
+    import winreg
+except ImportError:
+    try:
+        # Fall back to Python 2's _winreg
+        import _winreg as winreg
+    except ImportError:
+        winreg = None
+
 try:
     # For Python 3.0 and later
-    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
 except ImportError:
     # Fall back to Python 2's urllib2
-    from urllib2 import urlopen
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+try:
+    # For Python 3.0 and later
+    import queue
+except ImportError:
+    # Fall back to Python 2's Queue
+    import Queue as queue
+
+try:
+    # For Python 3.0 and later
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Fall back to Python 2's BaseHTTPServer
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    # For Python 3.0 and later
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Fall back to Python 2's SocketServer
+    from SocketServer import ThreadingMixIn
 
 try:
     import selenium
     from selenium import webdriver
-    from selenium.common.exceptions import NoSuchElementException
     from selenium.common.exceptions import TimeoutException
     from selenium.common.exceptions import WebDriverException
     from selenium.webdriver.support.select import Select
@@ -44,12 +93,10 @@ class Util(object):
     LOGGER_NAME = __file__
 
     @staticmethod
-    def diff_list(a, b):
-        return list(set(a).difference(set(b)))
-
-    @staticmethod
-    def intersect_list(a, b):
-        return list(set(a).intersection(set(b)))
+    def get_passrate(total, passed):
+        if float(total) == 0:
+            return 0
+        return float('%.2f' % (float(passed) / float(total) * 100))
 
     @staticmethod
     def ensure_dir(dir_path):
@@ -137,6 +184,36 @@ class Util(object):
         console.setFormatter(formatter)
         logger.addHandler(console)
 
+    # Call func with each of items in a thread of its own, and return the results
+    # in the order of items. Exceptions of all calls are logged, and the first
+    # one is raised again here.
+    @staticmethod
+    def map_parallel(func, items):
+        results = [None] * len(items)
+        errors = []
+
+        def call(index, item):
+            try:
+                results[index] = func(item)
+            except BaseException as error:
+                errors.append(error)
+
+        threads = []
+        for (index, item) in enumerate(items):
+            thread = threading.Thread(target=call, args=(index, item))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            # Util.error() has logged its message before exiting
+            if not isinstance(error, SystemExit):
+                Util.get_logger().error('%s: %s' % (type(error).__name__, error))
+        if errors:
+            raise errors[0]
+        return results
+
     @staticmethod
     def has_pkg(pkg):
         cmd = Cmd('dpkg -s ' + pkg)
@@ -167,15 +244,30 @@ class Util(object):
 
 
 class MobileDevice(object):
-    def __init__(self, id):
+    def __init__(self, id, model=''):
         self.id = id
+        self.model = model
+
+    def get_model(self):
+        return self.model
 
 class AndroidDevice(MobileDevice):
+    def __init__(self, id, model=''):
+        super(AndroidDevice, self).__init__(id, model)
+        # all properties are read by one adb command, as each takes a while
+        self.props = None
+
+    def get_model(self):
+        if not self.model:
+            self.model = self.get_prop('ro.product.model')
+        return self.model
+
     def get_prop(self, key):
-        cmd = AdbShellCmd('getprop | grep %s' % key, device_id=self.id)
-        match = re.search(r'\[%s\]: \[(.*)\]' % key, cmd.output)
-        if match:
-            return match.group(1)
+        if self.props is None:
+            cmd = AdbShellCmd('getprop', device_id=self.id)
+            self.props = dict(re.findall(r'^\[(.*?)\]: \[(.*)\]', cmd.output, re.M))
+        if key in self.props:
+            return self.props[key]
         else:
             Util.error('Could not find %s' % key)
 
@@ -201,6 +293,28 @@ class MobileDevices():
             else:
                 Util.error('Could not find mobile device with id %s' % device_id)
 
+    # device_ids is "all" or ids split by ","
+    def get_devices(self, device_ids):
+        if not device_ids:
+            return [self.get_device(device_ids)]
+        elif device_ids == 'all':
+            return self.devices
+        else:
+            return [self.get_device(device_id) for device_id in device_ids.split(',')]
+
+    # [(model, devices)] in the order of devices
+    def group_by_model(self, devices):
+        groups = []
+        models = Util.map_parallel(lambda device: device.get_model(), devices)
+        for (device, device_model) in zip(devices, models):
+            for (model, model_devices) in groups:
+                if model == device_model:
+                    model_devices.append(device)
+                    break
+            else:
+                groups.append((device_model, [device]))
+        return groups
+
 
 class AndroidDevices(MobileDevices):
     def initialize_devices(self):
@@ -229,16 +343,19 @@ class iOSDevices(MobileDevices):
             if re.match('Simulator', device_line):
                 continue
             else:
-                match = re.search(r'\[([a-f0-9]{40})\]', device_line)
+                # name (version) [udid], and devices of the same name are taken as the same model
+                match = re.search(r'^(.*?)\s*(\([^)]*\))?\s*\[([a-f0-9]{40})\]', device_line)
                 if match:
-                    self.devices.append(MobileDevice(match.group(1)))
+                    self.devices.append(MobileDevice(match.group(3), match.group(1)))
 
         if len(self.devices) < 1:
             Util.error('Could not find available iOS device')
 
 
+# The command runs in the background once created, so that independent
+# commands can run at the same time, and wait() collects its status and output.
 class Cmd(object):
-    def __init__(self, cmd, show_cmd=False, dryrun=False, abort=False):
+    def __init__(self, cmd, show_cmd=False, dryrun=False, abort=False, wait=True):
         self._logger = Util.get_logger()
         self.cmd = cmd
         self.show_cmd = show_cmd
@@ -254,35 +371,117 @@ class Cmd(object):
             self.process = None
             return
 
-        tmp_output = b''
-        process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for nextline in iter(process.stdout.readline, ''):
-            if nextline == b'':
-                break
-            tmp_output += nextline
+        self.status = None
+        self.output = None
+        self.process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        if self.status is None:
+            (out, error) = self.process.communicate()
+            self.status = self.process.returncode
+            self.output = (out + error).decode('utf-8')
+            if self.abort and self.status:
+                Util.error('Failed to execute %s' % self.cmd)
+        return self
+
+
+# A shell kept open on each device, so that a command doesn't pay for starting
+# adb and a shell on the device. Commands on the same device run one after
+# another, while those on different devices may run at the same time.
+class AdbShell(object):
+    END = '__ADB_SHELL_END__'
+    shells = {}
+    shells_lock = threading.Lock()
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        self.process = None
 
-        self.status = process.returncode
-        (out, error) = process.communicate()
-        self.output = tmp_output + out + error
-        self.output = self.output.decode('utf-8')
+    @staticmethod
+    def get(device_id):
+        with AdbShell.shells_lock:
+            if device_id not in AdbShell.shells:
+                AdbShell.shells[device_id] = AdbShell(device_id)
+            return AdbShell.shells[device_id]
 
-        self.process = process
+    @staticmethod
+    def close_all():
+        with AdbShell.shells_lock:
+            for shell in AdbShell.shells.values():
+                shell.close()
+            AdbShell.shells = {}
+
+    # Return (exit code, output) of cmd, or None if the shell can't be used,
+    # e.g., the device is gone. A shell closed on the way is opened again once.
+    def run(self, cmd):
+        with self.lock:
+            for _ in range(2):
+                if not self.process or self.process.poll() is not None:
+                    try:
+                        self.process = subprocess.Popen(['adb', '-s', self.device_id, 'shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    except OSError:
+                        return None
+                try:
+                    # the mark is split in the command, in case a shell with a tty echoes the command back
+                    self.process.stdin.write(('(%s) 2>&1; echo "%s""%s $?"\n' % (cmd, self.END[:8], self.END[8:])).encode('utf-8'))
+                    self.process.stdin.flush()
+                    output = ''
+                    while True:
+                        line = self.process.stdout.readline()
+                        if not line:
+                            raise IOError('adb shell on %s is closed' % self.device_id)
+                        line = line.decode('utf-8', 'replace').replace('\r', '')
+                        # output without a newline at the end is followed by the mark at once
+                        index = line.find(self.END)
+                        if index < 0:
+                            output += line
+                        else:
+                            output += line[:index]
+                            return (int(line[index + len(self.END):].strip() or 1), output)
+                except (IOError, OSError, ValueError):
+                    self.close()
+            return None
+
+    def close(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
 
-        if self.abort and self.status:
-            Util.error('Failed to execute %s' % cmd, error_code=self.status)
+atexit.register(AdbShell.close_all)
 
 
+# status is True if cmd succeeded on the device
 class AdbShellCmd(Cmd):
     def __init__(self, cmd, device_id, dryrun=False, abort=False):
-        fail_str = 'FAIL'
-        cmd = 'adb -s %s shell "(%s) || echo %s"' % (device_id, cmd, fail_str)
-        super(AdbShellCmd, self).__init__(cmd, dryrun, abort=False)
-        if re.search('FAIL', self.output):
-            if abort:
-                Util.error('Failed to execute %s' % cmd, error_code=self.status)
-            self.status = False
+        result = None
+        if not dryrun:
+            result = AdbShell.get(device_id).run(cmd)
+
+        if result is None:
+            fail_str = 'FAIL'
+            super(AdbShellCmd, self).__init__('adb -s %s shell "(%s) || echo %s"' % (device_id, cmd, fail_str), dryrun=dryrun)
+            self.status = not re.search(fail_str, self.output)
         else:
-            self.status = True
+            self._logger = Util.get_logger()
+            self.cmd = cmd
+            self.show_cmd = False
+            self.dryrun = dryrun
+            self.abort = abort
+            self.process = None
+            (exit_code, self.output) = result
+            self.status = exit_code == 0
+
+        if abort and not self.status:
+            Util.error('Failed to execute %s on device %s' % (cmd, device_id))
 
 
 class Timer(object):
@@ -377,9 +576,15 @@ class GPU(object):
 
 
 class GPUs(object):
-    def __init__(self, os, mobile_device, driver=None):
+    def __init__(self, os, mobile_device, driver=None, cache=None):
         self._logger = Util.get_logger()
         self.gpus = []
+        self.cache = cache
+
+        if cache and cache.get('gpus'):
+            for fields in cache.get('gpus'):
+                self.gpus.append(GPU(*fields))
+            return
 
         vendor_name = []
         vendor_id = []
@@ -486,26 +691,133 @@ class GPUs(object):
 
         if len(self.gpus) < 1:
             Util.error('Could not find any GPU')
+        if cache:
+            cache.set('gpus', [[gpu.vendor_name, gpu.vendor_id, gpu.product_name, gpu.product_id, gpu.driver_version] for gpu in self.gpus])
 
-    def get_active(self, driver):
+    # The active GPU is cached for the browser given by browser_key.
+    def get_active(self, driver, browser_key=None):
         if not driver or len(self.gpus) == 1:
             return self.gpus[0]
+
+        cache_name = None
+        if self.cache and browser_key:
+            cache_name = 'active:%s' % browser_key
+            index = self.cache.get(cache_name)
+            if index is not None and index < len(self.gpus):
+                return self.gpus[index]
+
+        gpu = self._detect_active(driver)
+        if cache_name:
+            self.cache.set(cache_name, self.gpus.index(gpu))
+        return gpu
+
+    def _detect_active(self, driver):
+        try:
+            debug_info = driver.execute_script('''
+                var canvas = document.createElement("canvas");
+                var gl = canvas.getContext("webgl");
+                var ext = gl.getExtension("WEBGL_debug_renderer_info");
+                return gl.getParameter(ext.UNMASKED_VENDOR_WEBGL) + " " + gl.getParameter(ext.UNMASKED_RENDERER_WEBGL);
+            ''')
+        except WebDriverException:
+            self._logger.warning('WEBGL_debug_renderer_info is not supported, so we assume first GPU from %s will be used' % self.gpus[0].vendor_name)
         else:
+            for gpu in self.gpus:
+                if re.search(gpu.vendor_name, debug_info, re.I) or re.search(gpu.product_name, debug_info, re.I):
+                    return gpu
+            self._logger.warning('Could not find the active GPU, so we assume first GPU from %s will be used' % self.gpus[0].vendor_name)
+        return self.gpus[0]
+
+
+# GPU info detected in earlier runs, as finding it may take seconds (lshw,
+# wmic, adb or chrome://gpu) or a WebGL context. The cache is only used on the
+# same machine, OS, kernel or build, device and GPU driver, and for at most
+# MAX_AGE.
+class FingerprintCache(object):
+    # seconds
+    MAX_AGE = 7 * 24 * 3600
+    # display adapters of Windows, with the version and date of their drivers
+    WIN_DISPLAY_KEY = r'SYSTEM\CurrentControlSet\Control\Class\{4d36e968-e325-11ce-bfc1-08002be10318}'
+    # libraries replaced by an update of Mesa or of a vendor driver on Linux
+    LINUX_DRIVER_PATTERNS = [
+        '/usr/lib*/libGL*.so*',
+        '/usr/lib*/libEGL*.so*',
+        '/usr/lib*/*/libGL*.so*',
+        '/usr/lib*/*/libEGL*.so*',
+        '/usr/lib*/*/libgallium*.so',
+        '/usr/lib*/dri/*.so',
+        '/usr/lib*/*/dri/*.so',
+    ]
+
+    def __init__(self, path, target_os, mobile_device=None, refresh=False):
+        self.path = path
+        self.driver_stamp = self._get_driver_stamp(target_os, mobile_device)
+        self.key = {
+            'node': platform.node(),
+            'release': platform.release(),
+            'version': platform.version(),
+            'target_os': str(target_os),
+            'device': mobile_device.id if mobile_device else '',
+            'driver': self.driver_stamp,
+        }
+        self.values = {}
+        self.time = time.time()
+        if not refresh and os.path.exists(path):
             try:
-                debug_info = driver.execute_script('''
-                    var canvas = document.createElement("canvas");
-                    var gl = canvas.getContext("webgl");
-                    var ext = gl.getExtension("WEBGL_debug_renderer_info");
-                    return gl.getParameter(ext.UNMASKED_VENDOR_WEBGL) + " " + gl.getParameter(ext.UNMASKED_RENDERER_WEBGL);
-                ''')
-            except WebDriverException:
-                self._logger.warning('WEBGL_debug_renderer_info is not supported, so we assume first GPU from %s will be used' % self.gpus[0].vendor_name)
-            else:
-                for gpu in self.gpus:
-                    if re.search(gpu.vendor_name, debug_info, re.I) or re.search(gpu.product_name, debug_info, re.I):
-                        return gpu
-                else:
-                    self._logger.warning('Could not find the active GPU, so we assume first GPU from %s will be used' % self.gpus[0].vendor_name)
+                f = open(path)
+                cache = json.load(f)
+                f.close()
+            except ValueError:
+                cache = {}
+            if cache.get('key') == self.key and time.time() - cache.get('time', 0) < self.MAX_AGE:
+                # keep the original time so that the cache still expires
+                self.values = cache['values']
+                self.time = cache['time']
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def set(self, name, value):
+        self.values[name] = value
+        f = open(self.path, 'w')
+        json.dump({'key': self.key, 'time': self.time, 'values': self.values}, f)
+        f.close()
+
+    # A cheap stamp of the GPU driver, as an update of the driver keeps the OS
+    # release and version. It's empty where the driver comes with the OS.
+    def _get_driver_stamp(self, target_os, mobile_device):
+        stamps = []
+        if target_os.is_android():
+            stamps.append(mobile_device.get_prop('ro.build.fingerprint'))
+        elif target_os.is_win() and winreg:
+            try:
+                key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, self.WIN_DISPLAY_KEY)
+            except OSError:
+                key = None
+            index = 0
+            while key:
+                try:
+                    name = winreg.EnumKey(key, index)
+                except OSError:
+                    break
+                index += 1
+                try:
+                    subkey = winreg.OpenKey(key, name)
+                    stamps.append('%s %s %s' % (name, winreg.QueryValueEx(subkey, 'DriverVersion')[0], winreg.QueryValueEx(subkey, 'DriverDate')[0]))
+                except OSError:
+                    # subkeys like Properties are not adapters
+                    pass
+        elif target_os.is_linux():
+            stamps += Util.read_file('/proc/driver/nvidia/version')
+            for pattern in self.LINUX_DRIVER_PATTERNS:
+                for path in sorted(glob.glob(pattern)):
+                    try:
+                        stamps.append('%s %s' % (path, os.path.getmtime(path)))
+                    except OSError:
+                        pass
+        if not stamps:
+            return ''
+        return hashlib.sha1('\n'.join(stamps).encode('utf-8')).hexdigest()
 
 
 class OS(object):
@@ -546,8 +858,8 @@ class HostOS(OS):
         # name
         system = platform.system().lower()
         if system == 'linux':
-            cmd = Cmd('cat /etc/lsb-release')
-            if re.search('CHROMEOS', cmd.output, re.I):
+            lsb_release_file = '/etc/lsb-release'
+            if os.path.exists(lsb_release_file) and re.search('CHROMEOS', ''.join(Util.read_file(lsb_release_file)), re.I):
                 self.name = 'cros'
             else:
                 self.name = 'linux'
@@ -668,6 +980,15 @@ class Browser(object):
             if match:
                 self.version = match.group(1)
 
+    # Cheap to get, and changes whenever the browser is updated or run with other options
+    def get_fingerprint(self):
+        path = getattr(self, 'path', '')
+        mtime = 0
+        if path and os.path.exists(path):
+            mtime = os.path.getmtime(path)
+        options = [option for option in self.options if not option.startswith('--user-data-dir=')]
+        return json.dumps([self.name, path, mtime, self.version, options])
+
     def is_chrome(self):
         return self._is_browser('chrome')
 
@@ -703,6 +1024,13 @@ class Webdriver(object):
         'chrome_public': 'org.chromium.chrome',
     }
 
+    # Webdrivers not quit yet, which are all quit at exit by one handler. It's
+    # registered with the first webdriver, so that it runs before the handlers
+    # registered earlier, e.g., the one removing user data dirs.
+    live = set()
+    live_lock = threading.Lock()
+    quit_all_registered = False
+
     def __init__(self, path, browser, host_os, target_os, mobile_device=None, debug=False, tools=False):
         self._logger = Util.get_logger()
         self.path = path
@@ -832,7 +1160,21 @@ class Webdriver(object):
         if not self.driver:
             Util.error('Could not get webdriver')
 
-        atexit.register(self._quit)
+        with Webdriver.live_lock:
+            Webdriver.live.add(self)
+            if not Webdriver.quit_all_registered:
+                atexit.register(Webdriver.quit_all)
+                Webdriver.quit_all_registered = True
+
+    @staticmethod
+    def quit_all():
+        with Webdriver.live_lock:
+            webdrivers = list(Webdriver.live)
+        for webdriver in webdrivers:
+            try:
+                webdriver.quit()
+            except Exception:
+                pass
 
     def _get_chrome_remote_debugging_port(self):
         chrome_pid = int(subprocess.check_output(['pgrep', '-o', '^chrome$']))
@@ -859,7 +1201,34 @@ class Webdriver(object):
             if port and try_bind(port, socket.SOCK_DGRAM, socket.IPPROTO_UDP):
                 return port
 
+    # Resident memory in MB of the browser processes started by the local
+    # webdriver, or None without psutil or for a remote browser.
+    def get_process_memory(self):
+        process = getattr(getattr(self.driver, 'service', None), 'process', None)
+        if not psutil or not process:
+            return None
+        try:
+            children = psutil.Process(process.pid).children(recursive=True)
+        except psutil.Error:
+            return None
+        rss = 0
+        for child in children:
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss / 1024.0 / 1024.0
+
+    def quit(self):
+        with Webdriver.live_lock:
+            Webdriver.live.discard(self)
+        if self.driver:
+            self._quit()
+            self.driver = None
+
     def _quit(self):
+        if not self.driver:
+            return
         self.driver.quit()
         if self.target_os.is_android() or self.target_os.is_cros():
             try:
@@ -875,6 +1244,153 @@ class Webdriver(object):
                 self._browser_to_create.CleanUpEnvironment()
 
 
+# Stand-in for a browser, to measure the overhead of the script itself on a
+# machine without any. It understands the scripts Conformance runs in the
+# harness page, and finishes each case after a delay drawn from a log-normal
+# distribution. The same cases fail in every run, and the browser crashes now
+# and then, so that retry and restart are measured as well.
+class FakeDriver(object):
+    USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.0.0 Safari/537.36'
+    FAIL_RATE = 0.05
+    CRASH_RATE = 0.002
+    SUBTEST_COUNT = 20
+    # bytes of JS heap, growing with each case like a real browser
+    HEAP_SIZE = 20 * 1024 * 1024
+    HEAP_GROWTH = 512 * 1024
+    # cases in each dir of the fake test list
+    DIR_CASE_COUNT = 100
+
+    lock = threading.Lock()
+    # seconds of all fake cases in all drivers
+    case_time = 0
+
+    def __init__(self, latency, jitter, seed):
+        # median in ms, and sigma of the log-normal distribution
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.crashed = False
+        self.collector_url = None
+        self.run_count = 0
+        self.results = {}
+        # token -> console messages of failed case
+        self.logs = {}
+
+    def get(self, url):
+        self._check()
+
+    def quit(self):
+        pass
+
+    # The same image for all cases, as many failures look alike
+    def get_screenshot_as_png(self):
+        self._check()
+        return b'\x89PNG fake screenshot'
+
+    def execute_script(self, script, *args):
+        self._check()
+        if script == Conformance.HOST_SCRIPT:
+            self.collector_url = args[2]
+        elif 'conformanceHost.run(' in script:
+            self._run(*args)
+        elif 'conformanceHost.getResult(' in script:
+            return self.results.pop(args[0], None)
+        elif 'conformanceHost.getLogs(' in script:
+            return self.logs.pop(args[0], [])
+        elif 'navigator.userAgent' in script:
+            return self.USER_AGENT
+        elif 'performance.memory' in script:
+            return self.HEAP_SIZE + self.HEAP_GROWTH * self.run_count
+        return None
+
+    # Write a test list of count cases into test_dir, for TestList to read.
+    @staticmethod
+    def create_test_list(test_dir, count):
+        Util.ensure_nodir(test_dir)
+        Util.ensure_dir(test_dir)
+        dir_names = []
+        for case_index in range(0, count, FakeDriver.DIR_CASE_COUNT):
+            dir_name = 'fake-%s' % len(dir_names)
+            dir_names.append(dir_name)
+            Util.ensure_dir('%s/%s' % (test_dir, dir_name))
+            f = open('%s/%s/00_test_list.txt' % (test_dir, dir_name), 'w')
+            for index in range(case_index, min(case_index + FakeDriver.DIR_CASE_COUNT, count)):
+                f.write('fake-case-%s.html\n' % index)
+            f.close()
+        f = open('%s/00_test_list.txt' % test_dir, 'w')
+        for dir_name in dir_names:
+            f.write('%s/00_test_list.txt\n' % dir_name)
+        f.close()
+
+    def _check(self):
+        if self.crashed:
+            raise WebDriverException('Fake browser crashed')
+
+    def _run(self, url, token):
+        self.run_count += 1
+        if self.random.random() < self.CRASH_RATE:
+            self.crashed = True
+            return
+
+        path = url.split('?')[0]
+        failed = int(hashlib.md5(path.encode('utf-8')).hexdigest(), 16) % 10000 < self.FAIL_RATE * 10000
+        duration = self.latency * math.exp(self.random.gauss(0, self.jitter))
+        with FakeDriver.lock:
+            FakeDriver.case_time += duration / 1000.0
+        timer = threading.Timer(duration / 1000.0, self._finish, args=(token, duration, failed))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, token, duration, failed):
+        if self.crashed:
+            return
+        statuses = Subtest.PASS * self.SUBTEST_COUNT
+        if failed:
+            statuses = statuses[:-1] + Subtest.FAIL
+            self.logs[token] = [[int(time.time() * 1000), 'console', 'error', 'fake console error']]
+        self.results[token] = {
+            'timedOut': False,
+            'time': duration,
+            'counts': {
+                Subtest.PASS: statuses.count(Subtest.PASS),
+                Subtest.FAIL: statuses.count(Subtest.FAIL),
+                Subtest.SKIP: 0,
+                Subtest.TIMEOUT: 0,
+            },
+            'statuses': statuses,
+            'messages': ['fake subtest %s' % index for index in range(len(statuses))],
+        }
+        try:
+            urlopen(self.collector_url, data=json.dumps({'token': token}).encode('utf-8'), timeout=10).close()
+        except Exception:
+            pass
+
+
+# Same interface as Webdriver, with a FakeDriver.
+class FakeWebdriver(object):
+    # set from --fake-latency, --fake-jitter and --fake-seed
+    latency = 20
+    jitter = 0.5
+    seed = 0
+    # sessions started so far for each browser
+    session_counts = {}
+
+    # Each browser, known by its device and user data dir, gets the same
+    # crashes and latencies in its nth session of every run with the seed.
+    def __init__(self, path, browser, host_os, target_os, mobile_device=None, debug=False, tools=False):
+        key = '%s-%s-%s' % (self.seed, mobile_device.id if mobile_device else '', ' '.join([option.split('/')[-1] for option in browser.options]))
+        with FakeDriver.lock:
+            count = FakeWebdriver.session_counts.get(key, 0)
+            FakeWebdriver.session_counts[key] = count + 1
+        self.driver = FakeDriver(self.latency, self.jitter, '%s-%s' % (key, count))
+
+    def get_process_memory(self):
+        return None
+
+    def quit(self):
+        self.driver = None
+
+
 class Status(object):
     PASS = 'PASS'
     FAIL = 'FAIL'
@@ -885,7 +1401,17 @@ class Status(object):
     NOTEXIST = 'NOTEXIST'
 
 
+class Subtest(object):
+    PASS = 'P'
+    FAIL = 'F'
+    SKIP = 'S'
+    TIMEOUT = 'T'
+
+
 class Case(object):
+    # There can be hundreds of thousands of cases when runs are merged
+    __slots__ = ('path', 'status', 'total_count', 'pass_count', 'time')
+
     def __init__(self, path='', status='', total_count=0, pass_count=0, time=0):
         self.path = path
         self.status = status
@@ -934,287 +1460,1374 @@ class Suite(object):
         self.count = 0
         self.exp_suite = exp_suite
 
-        self.issue_path = []
-        self.filter_path = []
-        self.retry_index = []
+        self.issue_path = set()
+        self.filter_path = set()
+        self.retry_set = set()
 
+    # A case with the path already in suite replaces the old one.
     def add_case(self, case):
-        self.suite.append(case)
-        self.path_index[case.path] = self.count
-        if not case.is_pass():
-            self.issue_path.append(case.path)
+        index = self.path_index.get(case.path)
+        if index is None:
+            index = self.count
+            self.suite.append(case)
+            self.path_index[case.path] = index
+            self.count += 1
+        else:
+            self.suite[index] = case
+
+        if case.is_pass():
+            self.issue_path.discard(case.path)
+        else:
+            self.issue_path.add(case.path)
         if case.is_filter():
-            self.filter_path.append(case.path)
+            self.filter_path.add(case.path)
+        else:
+            self.filter_path.discard(case.path)
         if case.is_fail() and self.exp_suite and case.path not in self.exp_suite.issue_path:
-            self.retry_index.append(self.count)
-        self.count += 1
+            self.retry_set.add(index)
+        else:
+            self.retry_set.discard(index)
+
+    # Cases of later runs win, so runs should be merged from the oldest.
+    def merge(self, cases):
+        for case in cases:
+            self.add_case(case)
 
     def get_case(self, index):
         return self.suite[index]
 
+    @property
+    def retry_index(self):
+        return sorted(self.retry_set)
+
     def remove_issue(self, index):
-        path = self.suite[index].path
-        del self.path_index[path]
-        self.issue_path.remove(path)
+        self.issue_path.discard(self.suite[index].path)
 
 
 class Change(object):
-    def __init__(self, exp_case, cur_case):
+    IMPROVE_PASS = 'improve_pass'  # passrate == 100%
+    IMPROVE_FAIL = 'improve_fail'  # passrate < 100%
+    REGRESS = 'regress'
+    REMAIN = 'remain'
+    PASS = 'pass'  # passed as expected
+    CATEGORIES = [IMPROVE_PASS, IMPROVE_FAIL, REGRESS, REMAIN, PASS]
+
+    __slots__ = ('exp_case', 'cur_case', 'category')
+
+    def __init__(self, exp_case, cur_case, category):
         self.exp_case = exp_case
         self.cur_case = cur_case
+        self.category = category
 
+    # Category by pass rates of both cases. A case no longer in the suite can't
+    # fail any more, unless it was filtered out, and a new case should pass.
+    @staticmethod
+    def get_category(exp_case, cur_case):
+        if cur_case.status == Status.NOTEXIST:
+            if exp_case.status == Status.FILTER:
+                return Change.REMAIN
+            elif exp_case.status == Status.PASS:
+                return Change.PASS
+            return Change.IMPROVE_PASS
+        if exp_case.status == Status.NOTEXIST:
+            if cur_case.status == Status.PASS:
+                return Change.PASS
+            return Change.REGRESS
+        exp_passrate = Util.get_passrate(exp_case.total_count, exp_case.pass_count)
+        cur_passrate = Util.get_passrate(cur_case.total_count, cur_case.pass_count)
+        if cur_passrate < exp_passrate:
+            return Change.REGRESS
+        elif cur_passrate > exp_passrate:
+            if cur_passrate == 100:
+                return Change.IMPROVE_PASS
+            return Change.IMPROVE_FAIL
+        elif cur_case.status == Status.PASS:
+            return Change.PASS
+        return Change.REMAIN
+
+
+# One browser session of a run. Each shard pulls case indexes from the queue
+# shared by all shards, and keeps its own browser, crash and resume state.
+class Shard(object):
+    def __init__(self, id, browser, user_data_dir=None, mobile_device=None):
+        self.id = id
+        self.browser = browser
+        self.user_data_dir = user_data_dir
+        self.mobile_device = mobile_device
+        self.webdriver = None
+        self.driver = None
+        # case index -> Case produced by this shard in firstrun
+        self.cases = {}
+        # (case index, Case) of each run by this shard in retry
+        self.retry_cases = []
+        # Crash in previous case may only be found in current case, so the
+        # previous case is kept here until it's safe to append it to resume.
+        self.pending_case = None
+        # key of the pending case in the result cache, put once the case is safe from crash
+        self.pending_cache_key = None
+        # ids of the current and pending cases given by the coordinator, in a worker
+        self.item_id = None
+        self.pending_item_id = None
+        self.aborted = False
+        self.run_count = 0
+        # cases run and passed by this shard in firstrun
+        self.case_count = 0
+        self.pass_count = 0
+        # cases run in the current browser session, and when memory was sampled
+        self.session_case_count = 0
+        self.sample_case_count = 0
+        # (reason, MB) of a recycle due once no page is in flight
+        self.recycle = None
+
+
+# Browser sessions launched and navigated to the harness ahead of time, so that
+# a shard whose browser crashed or hung can switch to one at once. The browser
+# given back by the shard is quit and launched again in the background.
+class StandbyPool(object):
+    def __init__(self, browsers, launch):
+        self._logger = Util.get_logger()
+        self.launch = launch
+        # (browser, Webdriver) ready to run cases
+        self.sessions = queue.Queue()
+        self.closed = False
+        for browser in browsers:
+            self.put(browser, None)
+
+    # Return (browser, webdriver) of a ready session, or None if there is none yet.
+    def get(self):
+        try:
+            return self.sessions.get_nowait()
+        except queue.Empty:
+            return None
 
-class Conformance(object):
-    VERSION_TYPE = {
-        '1.0.0': 'stable',
-        '1.0.1': 'stable',
-        '1.0.2': 'stable',
-        '1.0.3': 'stable',
-        '2.0.0': 'stable',
-        '1.0.4': 'beta',
-        '2.0.1': 'beta',
-    }
+    def put(self, browser, webdriver):
+        thread = threading.Thread(target=self._refill, args=(browser, webdriver))
+        thread.daemon = True
+        thread.start()
 
-    TEST_DONE = 'TESTDONE'
-    TOP_TIME_COUNT = 20
+    def close(self):
+        self.closed = True
+        while True:
+            session = self.get()
+            if not session:
+                break
+            session[1].quit()
 
-    def __init__(self):
-        # argument
-        parser = argparse.ArgumentParser(description='Khronos WebGL Conformance Test Script', formatter_class=argparse.ArgumentDefaultsHelpFormatter, epilog='''
-    examples:
-      python %(prog)s --browser_name chrome --version 2.0.1 --suite conformance/attribs
-    ''')
-        parser.add_argument('--browser-name', dest='browser_name', help='name of browser')
-        parser.add_argument('--browser-options', dest='browser_options', help='extra options of browser, split by ","')
-        parser.add_argument('--browser-path', dest='browser_path', help='path of browser')
-        parser.add_argument('--webdriver-path', dest='webdriver_path', help='path of webdriver')
-        parser.add_argument('--version', dest='version', help='WebGL conformance test version', default='2.0.1')
-        parser.add_argument('--url', dest='url', help='url for website other than default Khronos WebGL CTS')
-        parser.add_argument('--suite', dest='suite', help='instead of whole suite, we may test specific cases, e.g., conformance/attibs or "conformance/attribs/gl-bindAttribLocation-matrix.html"', default='all')
-        parser.add_argument('--os-name', dest='os_name', help='OS to run test on')
-        parser.add_argument('--device-id', dest='device_id', help='id of mobile device to run test on')
-        parser.add_argument('--mesa-dir', dest='mesa_dir', help='directory of Mesa')
-        parser.add_argument('--gles', dest='gles', help='gles', action='store_true')
-        parser.add_argument('--logging-level', dest='logging_level', help='level of logging', default=logging.INFO)
-        parser.add_argument('--timeout', dest='timeout', help='timeout seconds for each test', type=int, default=60)
-        parser.add_argument('--tools', dest='open_tools', help='show the developer tools for the browser', action='store_true')
+    def _refill(self, browser, webdriver):
+        if webdriver:
+            try:
+                webdriver.quit()
+            except Exception:
+                pass
+        if self.closed:
+            return
+        try:
+            webdriver = self.launch(browser)
+        except (SystemExit, Exception):
+            self._logger.warning('Could not launch a standby browser')
+            return
+        if self.closed:
+            webdriver.quit()
+        else:
+            self.sessions.put((browser, webdriver))
 
-        debug_group = parser.add_argument_group('debug')
-        debug_group.add_argument('--fixed-time', dest='fixed_time', help='fixed time', action='store_true')
-        debug_group.add_argument('--dryrun-test', dest='dryrun_test', help='dryrun test', action='store_true')
-        args = parser.parse_args()
+# Python counterpart of getFileList() in webgl-test-harness.js, so that cases
+# are known without loading the harness page.
+class TestList(object):
+    FILE_NAME = '00_test_list.txt'
 
-        # timestamp
-        if args.fixed_time:
-            self.timestamp = Util.get_datetime(format='%Y%m%d')
+    def __init__(self, test_dir, version, min_version=None, max_version=None):
+        self.test_dir = test_dir
+        self.version = version
+        self.min_version = min_version
+        self.max_version = max_version
+        self.paths = []
+        self._add_file(self.FILE_NAME, {'min_version': '1.0', 'max_version': None})
+
+    def get_paths(self, suite='all'):
+        suite = re.sub('^all/?', '', suite)
+        if not suite:
+            return list(self.paths)
+        return [path for path in self.paths if path == suite or path.startswith(suite.rstrip('/') + '/')]
+
+    def _add_file(self, path, defaults):
+        file_path = '%s/%s' % (self.test_dir, path)
+        if not os.path.exists(file_path):
+            Util.error('Could not find test list %s' % file_path)
+
+        prefix = path[:path.rfind('/') + 1]
+        for (line_num, line) in enumerate(Util.read_file(file_path)):
+            line = line.strip()
+            if len(line) > 4 and not line.startswith(('#', ';', '//')):
+                self._add_line(prefix, line, '%s:%s' % (path, line_num + 1), dict(defaults))
+
+    def _add_line(self, prefix, line, location, defaults):
+        args = line.split()
+        names = []
+        options = {}
+        index = 0
+        while index < len(args):
+            arg = args[index]
+            if arg == '--slow':
+                pass
+            elif arg in ['--min-version', '--max-version']:
+                index += 1
+                options[arg[2:].replace('-', '_')] = args[index]
+            elif arg.startswith('-'):
+                Util.error('Unknown option %s at %s' % (arg, location))
+            else:
+                names.append(arg)
+            index += 1
+        path = prefix + ' '.join(names)
+
+        if path.endswith('.txt'):
+            defaults.update(options)
+            self._add_file(path, defaults)
+        elif self._is_used(options.get('min_version', defaults['min_version']), options.get('max_version', defaults['max_version'])):
+            self.paths.append(path)
+
+    def _is_used(self, min_version, max_version):
+        if self.min_version:
+            return self._is_version_ge(min_version, self.min_version)
+        elif self.max_version and max_version:
+            return self._is_version_ge(self.max_version, max_version)
         else:
-            self.timestamp = Util.get_datetime()
+            is_used = self._is_version_ge(self.version, min_version)
+            if max_version:
+                is_used = is_used and self._is_version_ge(max_version, self.version)
+            return is_used
 
-        # log
-        work_dir = Util.use_slash(sys.path[0])
-        os.chdir(work_dir)
-        self.log_dir = 'log'
-        Util.ensure_dir(self.log_dir)
-        self.log_file = '%s/%s.log' % (self.log_dir, self.timestamp)
-        Util.ensure_nofile(self.log_file)
-        Util.set_logger(self.log_file, args.logging_level)
-        self._logger = Util.get_logger()
-        self.resume_file = '%s/resume' % self.log_dir
+    @staticmethod
+    def _is_version_ge(have, want):
+        have = have.split(' ')[0].split('.')
+        want = want.split(' ')[0].split('.')
+        for index in range(len(want)):
+            want_num = int(want[index])
+            if index < len(have):
+                have_num = int(have[index])
+            else:
+                have_num = 0
+            if have_num > want_num:
+                return True
+            if have_num < want_num:
+                return False
+        return True
 
-        # result
-        self.result_dir = 'result'
-        Util.ensure_dir(self.result_dir)
-        self.result_file = '%s/%s.html' % (self.result_dir, self.timestamp)
 
-        # device
-        self.mobile_device = None
-        if args.os_name == 'android':
-            self.mobile_device = AndroidDevices().get_device(args.device_id)
-        elif args.os_name == 'ios':
-            self.mobile_device = iOSDevices().get_device(args.device_id)
+# Subtest results of a run, one JSON line per case in a gzip file. Statuses of
+# subtests are kept as a string of Subtest characters, aligned with messages.
+# A case run again in retry gets another line, and the last line wins.
+class SubtestStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'wb')
+
+    def add(self, case_path, result):
+        record = {
+            'path': case_path,
+            'time': result['time'],
+            'counts': result['counts'],
+            'statuses': result['statuses'],
+            'messages': result['messages'],
+        }
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line.encode('utf-8'))
+
+    def close(self):
+        self.file.close()
 
-        # OS
-        self.host_os = HostOS()
-        if args.os_name == 'android':
-            self.target_os = AndroidOS(self.mobile_device)
-        elif args.os_name == 'ios':
-            self.target_os = OS("ios")
-        else:
-            self.target_os = self.host_os
+    @staticmethod
+    def read(path):
+        records = {}
+        f = gzip.open(path, 'rb')
+        for line in f:
+            record = json.loads(line.decode('utf-8'))
+            records[record['path']] = record
+        f.close()
+        return records
 
-        # browser
-        if args.browser_name:
-            browser_name = args.browser_name
-        elif self.target_os.is_cros():
-            browser_name = 'chrome'
-        else:
-            Util.error('Please designate browser name')
-        if args.browser_options:
-            browser_options = args.browser_options.split(',')
-        else:
-            browser_options = []
 
-        if args.gles and self.target_os.is_linux() and 'chrome' in browser_name:
-            browser_options.append('--use-gl=egl')
+# Console messages of cases that did not pass, one JSON line per case in a gzip
+# file. Each message is [ms since epoch, source, level, text], where source is
+# console for the test page, and runner for errors found by this script.
+class CaseLogStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, 'wb')
+
+    def add(self, case, logs):
+        record = {
+            'path': case.path,
+            'status': case.status,
+            'logs': logs,
+        }
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line.encode('utf-8'))
+
+    def close(self):
+        self.file.close()
+
+
+# Screenshots and canvas readbacks of cases that did not pass, stored by the
+# SHA-256 of their content as <path>/<first 2 digits>/<digest>.png. The same
+# image from many cases, shards or runs is only written once, and reports refer
+# to images by digest. The digests of the last run of each case are kept.
+class ArtifactStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # case path -> digests
+        self.digests = {}
+        self.write_count = 0
+        self.dup_count = 0
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.get_path(digest)
+        if os.path.exists(path):
+            with self.lock:
+                self.dup_count += 1
+            return digest
+        Util.ensure_dir(os.path.dirname(path))
+        # other shards or processes may write the same image at the same time
+        tmp_path = '%s.%s-%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        f = open(tmp_path, 'wb')
+        f.write(data)
+        f.close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+        with self.lock:
+            self.write_count += 1
+        return digest
+
+    def get_path(self, digest):
+        return '%s/%s/%s.png' % (self.path, digest[:2], digest)
+
+    def set(self, case_path, digests):
+        with self.lock:
+            self.digests[case_path] = digests
+
+    def get(self, case_path):
+        return self.digests.get(case_path, [])
+
+
+# Timed phases of cases, written as they end to a trace file in Chrome
+# trace-event format, which chrome://tracing or Perfetto can open. Each shard
+# is a thread of the trace. Total time of each phase is kept for the report.
+class Tracer(object):
+    SESSION_START = 'session start'
+    HARNESS_LOAD = 'harness load'
+    LOOKUP = 'lookup'
+    START_CASE = 'start case'
+    WAIT_RESULT = 'wait result'
+    PARSE_RESULT = 'parse result'
+    RESUME_WRITE = 'resume write'
+    PHASES = [SESSION_START, HARNESS_LOAD, LOOKUP, START_CASE, WAIT_RESULT, PARSE_RESULT, RESUME_WRITE]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        # phase -> [count, seconds]
+        self.totals = dict((phase, [0, 0]) for phase in self.PHASES)
+        self.file = open(path, 'w')
+        # the closing bracket is optional, so a trace cut short can still be loaded
+        self.file.write('[')
+        self.separator = '\n'
+
+    # Add a phase that began at start_time and ends now.
+    def add(self, phase, start_time, shard, case_path=None):
+        end_time = time.time()
+        event = {
+            'name': phase,
+            'cat': 'conformance',
+            'ph': 'X',
+            'ts': int((start_time - self.start_time) * 1000000),
+            'dur': int((end_time - start_time) * 1000000),
+            'pid': 0,
+            'tid': shard.id,
+        }
+        if case_path:
+            event['args'] = {'case': case_path}
+        line = json.dumps(event, separators=(',', ':'))
+        with self.lock:
+            self.file.write(self.separator + line)
+            self.separator = ',\n'
+            self.totals[phase][0] += 1
+            self.totals[phase][1] += end_time - start_time
+
+    def close(self):
+        self.file.write('\n]\n')
+        self.file.close()
+
+
+# Journal of cases finished in the first run, so that an interrupted run can be
+# resumed. Cases are keyed by run id and path, so shards may add them in any
+# order, and a run can be resumed on another machine by copying the file and
+# passing --run-id. Cases are committed in batches to bound the cost of syncing,
+# so a crash of the script itself loses at most the last batch.
+class ResumeJournal(object):
+    BATCH_SIZE = 20
+    # seconds
+    BATCH_INTERVAL = 10
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.batch_count = 0
+        self.batch_time = time.time()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS run (id TEXT PRIMARY KEY, suite TEXT, done INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS result (run_id TEXT, path TEXT, status TEXT, total_count INTEGER, pass_count INTEGER, time REAL, PRIMARY KEY (run_id, path))')
+        self.conn.commit()
+
+    # Without run_id, the last unfinished run of the same suite is resumed, or
+    # a new run with new_run_id is started. Return the cases already finished.
+    def open_run(self, suite, run_id, new_run_id):
+        with self.lock:
+            if run_id:
+                row = self.conn.execute('SELECT suite, done FROM run WHERE id = ?', (run_id,)).fetchone()
+                if not row:
+                    Util.error('Run %s is not in the resume journal' % run_id)
+                if row[0] != suite:
+                    Util.error('The suite currently tested is different from the resumed one')
+                if row[1]:
+                    Util.error('Run %s is already done' % run_id)
+            else:
+                row = self.conn.execute('SELECT id FROM run WHERE suite = ? AND done = 0 ORDER BY rowid DESC LIMIT 1', (suite,)).fetchone()
+                if row:
+                    run_id = row[0]
+                else:
+                    run_id = new_run_id
+                    self.conn.execute('DELETE FROM run WHERE id = ?', (run_id,))
+                    self.conn.execute('DELETE FROM result WHERE run_id = ?', (run_id,))
+                    self.conn.execute('INSERT INTO run VALUES (?, ?, 0)', (run_id, suite))
+                    self.conn.commit()
+            self.run_id = run_id
+
+            cases = []
+            for row in self.conn.execute('SELECT path, status, total_count, pass_count, time FROM result WHERE run_id = ?', (run_id,)):
+                cases.append(Case(*row))
+            return cases
+
+    def add(self, case):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO result VALUES (?, ?, ?, ?, ?, ?)',
+                (self.run_id, case.path, case.status, case.total_count, case.pass_count, case.time)
+            )
+            self.batch_count += 1
+            if self.batch_count >= self.BATCH_SIZE or time.time() - self.batch_time >= self.BATCH_INTERVAL:
+                self._commit()
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def finish_run(self):
+        with self.lock:
+            self.conn.execute('UPDATE run SET done = 1 WHERE id = ?', (self.run_id,))
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def _commit(self):
+        self.conn.commit()
+        self.batch_count = 0
+        self.batch_time = time.time()
+
+
+# Durations of cases in past runs, so that the longest cases can be run first
+# and shards finish at about the same time, and hung cases can be told from
+# slow ones. Only the last HISTORY_SIZE durations of each case are kept.
+# Durations of the current run are saved by save() and only used by later runs.
+class TimingHistory(object):
+    HISTORY_SIZE = 10
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS timing (path TEXT, time REAL, timed_out INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS timing_path ON timing (path)')
+        self.conn.commit()
+
+        # path -> durations in ms, the oldest first
+        self.times = {}
+        # path -> durations in ms of runs not timed out
+        self.finish_times = {}
+        for (path, duration, timed_out) in self.conn.execute('SELECT path, time, timed_out FROM timing ORDER BY rowid'):
+            self.times.setdefault(path, []).append(duration)
+            if not timed_out:
+                self.finish_times.setdefault(path, []).append(duration)
+        self.new_times = []
+
+    def add(self, path, duration, timed_out=False):
+        with self.lock:
+            self.new_times.append((path, duration, int(timed_out)))
+
+    def get_times(self, path):
+        return self.times.get(path, [])
+
+    # the percentile of durations of runs not timed out, or None without any
+    def get_percentile(self, path, percentile):
+        times = sorted(self.finish_times.get(path, []))
+        if not times:
+            return None
+        return times[max(int(math.ceil(len(times) * percentile / 100.0)) - 1, 0)]
+
+    # median of past durations, or default if the case has never been run
+    def estimate(self, path, default=0):
+        times = sorted(self.get_times(path))
+        if not times:
+            return default
+        return times[len(times) // 2]
+
+    def save(self):
+        with self.lock:
+            new_times = self.new_times
+            self.new_times = []
+        if not new_times:
+            return
+        self.conn.executemany('INSERT INTO timing VALUES (?, ?, ?)', new_times)
+        for path in set(new_time[0] for new_time in new_times):
+            self.conn.execute(
+                'DELETE FROM timing WHERE rowid IN (SELECT rowid FROM timing WHERE path = ? ORDER BY rowid DESC LIMIT -1 OFFSET ?)',
+                (path, self.HISTORY_SIZE)
+            )
+        self.conn.commit()
+
+    def close(self):
+        self.save()
+        self.conn.close()
+
+
+# Runs of cases in the retry of past runs, i.e., after failing unexpectedly.
+# The flake score of a case is the fraction of these runs that passed, so a
+# case failing for real scores 0 while a flaky one scores close to 1.
+class FlakeHistory(object):
+    # runs needed before a case may be quarantined
+    MIN_RUNS = 3
+    # runs in a row a case is quarantined in, before it's retried again in one
+    # run so that its score can change
+    QUARANTINE_RUNS = 10
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS flake (path TEXT PRIMARY KEY, runs INTEGER, passes INTEGER, total_count INTEGER, pass_count INTEGER)')
+        # path -> runs in a row the case has been quarantined in
+        self.conn.execute('CREATE TABLE IF NOT EXISTS quarantine (path TEXT PRIMARY KEY, runs INTEGER)')
+        self.conn.commit()
+        self.paths = set(row[0] for row in self.conn.execute('SELECT path FROM flake'))
+        self.new_flakes = []
+        self.new_cleans = []
+
+    # total_count and pass_count are of the last failure before the retry
+    def add(self, path, runs, passes, total_count, pass_count):
+        with self.lock:
+            self.new_flakes.append((path, runs, passes, total_count, pass_count))
+
+    # A case with a history passing without retry counts as a run that didn't
+    # pass after a failure, which lowers its score.
+    def add_clean(self, path):
+        if path not in self.paths:
+            return
+        with self.lock:
+            self.new_cleans.append(path)
+
+    # Return (path, total_count, pass_count) of cases in case_paths whose score
+    # is at least min_score, except those quarantined in the last
+    # QUARANTINE_RUNS runs, which are retried in this run instead.
+    def get_quarantined(self, min_score, case_paths):
+        rows = self.conn.execute(
+            'SELECT path, total_count, pass_count FROM flake WHERE runs >= ? AND passes >= runs * ?',
+            (self.MIN_RUNS, min_score)
+        ).fetchall()
+        quarantine_runs = dict(self.conn.execute('SELECT path, runs FROM quarantine'))
+        quarantined = []
+        for row in rows:
+            if row[0] not in case_paths:
+                continue
+            runs = quarantine_runs.get(row[0], 0)
+            if runs >= self.QUARANTINE_RUNS:
+                runs = 0
+            else:
+                runs += 1
+                quarantined.append(row)
+            self.conn.execute('INSERT OR REPLACE INTO quarantine VALUES (?, ?)', (row[0], runs))
+        self.conn.commit()
+        return quarantined
+
+    # Paths of cases that passed at least once in retry after failing
+    def get_flaky_paths(self):
+        return [row[0] for row in self.conn.execute('SELECT path FROM flake WHERE passes > 0')]
+
+    def save(self):
+        with self.lock:
+            new_flakes = self.new_flakes
+            self.new_flakes = []
+            new_cleans = self.new_cleans
+            self.new_cleans = []
+        for (path, runs, passes, total_count, pass_count) in new_flakes:
+            self.conn.execute('INSERT OR IGNORE INTO flake VALUES (?, 0, 0, 0, 0)', (path,))
+            self.conn.execute(
+                'UPDATE flake SET runs = runs + ?, passes = passes + ?, total_count = ?, pass_count = ? WHERE path = ?',
+                (runs, passes, total_count, pass_count, path)
+            )
+            self.paths.add(path)
+        for path in new_cleans:
+            self.conn.execute('UPDATE flake SET runs = runs + 1 WHERE path = ?', (path,))
+        self.conn.commit()
+
+    def close(self):
+        self.save()
+        self.conn.close()
+
+
+# Results of cases keyed by the content of their page, the files it uses,
+# directly or through other files, and the fingerprint of GPU, OS and browser.
+# A case whose key is found needn't be run again. Only passed and failed cases
+# are kept, as crashes and timeouts are not reliable enough to be reused.
+class ResultCache(object):
+    # attributes and string literals that may refer to files used by a page
+    REF_PATTERN = re.compile(r'''(?:src|href)\s*=\s*["']([^"']+)["']|["']([^"'\s]+\.(?:js|html|css|vert|frag|glsl|png|jpg|jpeg|gif|svg|webm|mp4|ogv|ogg|m4v|wav|mp3|txt|json))["']''')
+    # files whose references are followed
+    PARSED_EXTENSIONS = ('.html', '.js', '.css')
+    # Closure modules, e.g., of deqp, are loaded by goog.require() from paths
+    # given by goog.addDependency() in a deps file, relative to the dir of base.js
+    GOOG_BASE = '/goog/base.js'
+    GOOG_DEPENDENCY_PATTERN = re.compile(r'''goog\.addDependency\(\s*['"]([^'"]+)['"]\s*,\s*\[([^\]]*)\]\s*,\s*\[([^\]]*)\]''')
+    GOOG_REQUIRE_PATTERN = re.compile(r'''goog\.require\(\s*['"]([^'"]+)['"]\s*\)''')
+    GOOG_NAMESPACE_PATTERN = re.compile(r'''['"]([^'"]+)['"]''')
+
+    def __init__(self, path, test_dir, fingerprint):
+        self.test_dir = test_dir
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        # file path -> hash of content
+        self.file_hashes = {}
+        # file path -> (paths of files it refers to, closure namespaces it requires)
+        self.file_refs = {}
+        # deps file path -> [(path relative to base.js, provided namespaces, required namespaces)]
+        self.goog_deps = {}
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS result (key TEXT PRIMARY KEY, path TEXT, status TEXT, total_count INTEGER, pass_count INTEGER, time REAL)')
+        self.conn.commit()
+
+    def get_key(self, case_path):
+        file_path = os.path.normpath('%s/%s' % (self.test_dir, case_path))
+        if not os.path.exists(file_path):
+            return None
+        key = hashlib.sha1(self.fingerprint.encode('utf-8'))
+        for dep_path in sorted(self._get_deps(file_path)):
+            key.update(('%s:%s\n' % (os.path.relpath(dep_path, self.test_dir), self._get_file_hash(dep_path))).encode('utf-8'))
+        return key.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT path, status, total_count, pass_count, time FROM result WHERE key = ?', (key,)).fetchone()
+        if row:
+            return Case(*row)
+        return None
+
+    def put(self, key, case):
+        if not case.is_pass() and not case.is_fail():
+            return
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO result VALUES (?, ?, ?, ?, ?, ?)',
+                (key, case.path, case.status, case.total_count, case.pass_count, case.time)
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # all files used by the page, including the page itself
+    def _get_deps(self, file_path):
+        deps = set([file_path])
+        pending = [file_path]
+        # closure namespaces required, and those already followed
+        namespaces = set()
+        followed_namespaces = set()
+        while pending:
+            while pending:
+                (refs, requires) = self._get_refs(pending.pop())
+                namespaces.update(requires)
+                for ref_path in refs:
+                    if ref_path not in deps:
+                        deps.add(ref_path)
+                        pending.append(ref_path)
+
+            # namespace -> (file path, required namespaces), from deps files used by the page
+            provides = {}
+            for base_path in [dep_path for dep_path in deps if Util.use_slash(dep_path).endswith(self.GOOG_BASE)]:
+                base_dir = os.path.dirname(base_path)
+                for dep_path in deps:
+                    for (path, provided, required) in self.goog_deps.get(dep_path, []):
+                        for namespace in provided:
+                            provides[namespace] = (os.path.normpath('%s/%s' % (base_dir, path)), required)
+            while namespaces - followed_namespaces:
+                namespace = (namespaces - followed_namespaces).pop()
+                followed_namespaces.add(namespace)
+                if namespace not in provides:
+                    continue
+                (ref_path, required) = provides[namespace]
+                namespaces.update(required)
+                if ref_path not in deps and os.path.isfile(ref_path):
+                    deps.add(ref_path)
+                    pending.append(ref_path)
+        return deps
+
+    def _get_refs(self, file_path):
+        if file_path in self.file_refs:
+            return self.file_refs[file_path]
+
+        refs = []
+        requires = []
+        if file_path.endswith(self.PARSED_EXTENSIONS):
+            f = open(file_path, 'rb')
+            content = f.read().decode('utf-8', 'replace')
+            f.close()
+            file_dir = os.path.dirname(file_path)
+            for match in self.REF_PATTERN.finditer(content):
+                ref = (match.group(1) or match.group(2)).split('?')[0].split('#')[0]
+                if not ref or ref.startswith('/') or ':' in ref:
+                    continue
+                ref_path = os.path.normpath('%s/%s' % (file_dir, ref))
+                if os.path.isfile(ref_path):
+                    refs.append(ref_path)
+            requires = self.GOOG_REQUIRE_PATTERN.findall(content)
+            goog_deps = []
+            for match in self.GOOG_DEPENDENCY_PATTERN.finditer(content):
+                goog_deps.append((match.group(1), self.GOOG_NAMESPACE_PATTERN.findall(match.group(2)), self.GOOG_NAMESPACE_PATTERN.findall(match.group(3))))
+            if goog_deps:
+                self.goog_deps[file_path] = goog_deps
+        self.file_refs[file_path] = (refs, requires)
+        return (refs, requires)
+
+    def _get_file_hash(self, file_path):
+        if file_path not in self.file_hashes:
+            f = open(file_path, 'rb')
+            self.file_hashes[file_path] = hashlib.sha1(f.read()).hexdigest()
+            f.close()
+        return self.file_hashes[file_path]
 
-        if 'chrome' in browser_name and not self.target_os.is_android() and not self.target_os.is_cros():
-            user_data_dir = 'user-data-dir-%s' % self.target_os.username
-            browser_options.append('--user-data-dir=%s' % (work_dir + '/' + user_data_dir))
-            Util.ensure_nodir(user_data_dir)
-            Util.ensure_dir(user_data_dir)
 
-        self.browser = Browser(name=browser_name, path=args.browser_path, options=browser_options, os=self.target_os)
+# Local HTTP endpoint the host script in the harness page posts results to, so
+# that the runner wakes up as soon as a case finishes instead of polling.
+class ResultCollector(object):
+    def __init__(self):
+        self._logger = Util.get_logger()
+        self.tokens = set()
+        self.results = {}
+        self.condition = threading.Condition()
 
-        # others
-        self.webdriver_path = args.webdriver_path
-        self.args = args
-        self.timeout = args.timeout
-        self.open_tools = args.open_tools
+        collector = self
 
-        # url
-        self.version = args.version
-        if args.url:
-            self.url = args.url
-        else:
-            self.url = 'https://www.khronos.org/registry/webgl'
-            if self.version not in self.VERSION_TYPE:
-                Util.error('The version %s is not supported' % self.version)
-            type = self.VERSION_TYPE[self.version]
-            if type == 'stable':
-                self.url += '/conformance-suites/%s/webgl-conformance-tests.html' % self.version
-            elif type == 'beta':
-                self.url += '/sdk/tests/webgl-conformance-tests.html?version=%s' % self.version
+        class Handler(BaseHTTPRequestHandler):
+            def do_OPTIONS(self):
+                self.send_response(204)
+                self._send_cors_headers()
+                self.end_headers()
 
-        # runtime env
-        mesa_dir = args.mesa_dir
-        if self.target_os.is_linux() and mesa_dir:
-            Util.set_env('LD_LIBRARY_PATH', mesa_dir + '/lib')
-            Util.set_env('LIBGL_DRIVERS_PATH', mesa_dir + '/lib/dri')
+            def do_POST(self):
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    collector.put(json.loads(body.decode('utf-8')))
+                except ValueError:
+                    collector._logger.warning('Could not parse result posted to collector')
+                self.send_response(204)
+                self._send_cors_headers()
+                self.end_headers()
+
+            def _send_cors_headers(self):
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Access-Control-Allow-Methods', 'POST')
+                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+                self.send_header('Access-Control-Allow-Private-Network', 'true')
+
+            def log_message(self, format, *args):
+                pass
 
-        if args.gles and self.target_os.is_linux() and self.gpu.is_intel():
-            pkg = 'libgles-mesa'
-            if not Util.has_pkg(pkg):
-                Util.error('Package %s is not installed' % pkg)
-        if args.gles and self.gpu.is_nvidia():
-            Util.set_env('LD_LIBRARY_PATH', '/usr/lib/nvidia-' + self.gpu.version.split('.')[0])
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:%s/' % self.port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def expect(self, token):
+        with self.condition:
+            self.tokens.add(token)
+
+    def discard(self, token):
+        with self.condition:
+            self.tokens.discard(token)
+            self.results.pop(token, None)
+
+    def put(self, result):
+        with self.condition:
+            if result.get('token') in self.tokens:
+                self.results[result['token']] = result
+                self.condition.notify_all()
+
+    def wait(self, token, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while token not in self.results:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            self.tokens.discard(token)
+            return self.results.pop(token)
+
+    # Return the first of tokens with a result, or None on timeout
+    def wait_any(self, tokens, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                for token in tokens:
+                    if token in self.results:
+                        self.tokens.discard(token)
+                        self.results.pop(token)
+                        return token
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+# Coordinator of a distributed run, serving cases to workers on other machines
+# with identical GPUs, or on the same machine. A worker registers its
+# environment and gets the case list, then pulls batches of cases and posts the
+# result of each case back. Cases held by a worker not heard from for
+# WORKER_TIMEOUT seconds are put back to the queue for other workers.
+class Coordinator(object):
+    BATCH_SIZE = 10
+    # seconds
+    POLL_INTERVAL = 1
+    WORKER_TIMEOUT = 60
+
+    # register(worker_id) returns the Shard of a new worker.
+    # skip(shard, mode, index, case_index, total_count) returns (done, cache key)
+    # of a case before it's given to a worker.
+    # add(shard, mode, index, case_index, total_count, case, cache_key) takes
+    # the result of a case from a worker.
+    # Only requests with the token in header X-Coordinator-Token are served, as
+    # anyone reaching the port could otherwise take cases or post results.
+    def __init__(self, port, case_paths, version, register, skip, add, bind='127.0.0.1', token=None):
+        self._logger = Util.get_logger()
+        self.token = token or hashlib.sha1(os.urandom(32)).hexdigest()
+        self.case_paths = case_paths
+        self.version = version
+        self.register = register
+        self.skip = skip
+        self.add = add
+        self.condition = threading.Condition()
+        # environment of the first worker, which all others should have as well
+        self.env = None
+        self.env_key = None
+        self.worker_count = 0
+        # worker id -> Shard and time it's last heard from, of live workers
+        self.workers = {}
+        self.last_seen = {}
+        # (index in this mode, case index) not given to any worker yet
+        self.mode = None
+        self.fresh = False
+        self.total_count = 0
+        self.items = collections.deque()
+        # item id -> (worker id, index in this mode, case index, cache key)
+        self.outstanding = {}
+        self.item_count = 0
+        self.done = False
+        self.done_workers = set()
+
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    if not hmac.compare_digest(str(self.headers.get('X-Coordinator-Token', '')), str(coordinator.token)):
+                        (code, response) = (401, {'error': 'Wrong token'})
+                    else:
+                        (code, response) = coordinator.handle(self.path, json.loads(body.decode('utf-8')))
+                except (KeyError, TypeError, ValueError):
+                    (code, response) = (400, {'error': 'Bad request'})
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
 
-        # test
-        if args.dryrun_test:
-            self.exp_suite = Suite()
-            self.cur_suite = Suite(self.exp_suite)
-            self.driver = None
-            self.gpu = self.gpus.get_active(self.driver)
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((bind, port), Handler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    # Return (HTTP status, response) of a request from a worker.
+    def handle(self, path, request):
+        with self.condition:
+            if path == '/register':
+                return self._register(request)
+
+            worker_id = request['worker_id']
+            if worker_id not in self.workers:
+                return (410, {'error': 'Worker %s is unknown or was taken as dead' % worker_id})
+            self.last_seen[worker_id] = time.time()
+            if path == '/heartbeat':
+                return (200, {})
+            elif path == '/batch':
+                return (200, self._get_batch(worker_id))
+            elif path == '/result':
+                self._put(worker_id, request['item_id'], Case(*request['case']))
+                return (200, {})
+            return (404, {'error': 'Unknown request %s' % path})
+
+    # Wait for the first worker, and return its environment.
+    def wait_env(self):
+        with self.condition:
+            while not self.env:
+                self.condition.wait(self.POLL_INTERVAL)
+            return self.env
+
+    # Serve (index in this mode, case index) of run_indexes until all are done.
+    def run(self, mode, run_indexes, total_count, fresh=False):
+        with self.condition:
+            self.mode = mode
+            self.fresh = fresh
+            self.total_count = total_count
+            self.items = collections.deque(run_indexes)
+            while self.items or self.outstanding:
+                self.condition.wait(self.POLL_INTERVAL)
+                self._check_workers()
+            self.mode = None
+
+    # Tell live workers there is nothing more to run.
+    def finish(self):
+        deadline = time.time() + self.WORKER_TIMEOUT
+        with self.condition:
+            self.done = True
+            while set(self.workers) - self.done_workers and time.time() < deadline:
+                self.condition.wait(self.POLL_INTERVAL)
+                self._check_workers()
+        # other shards of the workers may be on the way to ask for more
+        time.sleep(self.POLL_INTERVAL)
+        self.server.shutdown()
+
+    def _register(self, request):
+        env = request['env']
+        env_key = [env['gpu'], env['target_os'], env['browser']['name'], env['browser']['version']]
+        if request['version'] != self.version:
+            return (409, {'error': 'The worker tests version %s rather than %s' % (request['version'], self.version)})
+        if not self.env:
+            self.env = env
+            self.env_key = env_key
+        elif env_key != self.env_key:
+            return (409, {'error': 'GPU, OS or browser of the worker is different from the one of the first worker'})
+
+        worker_id = self.worker_count
+        self.worker_count += 1
+        self.workers[worker_id] = self.register(worker_id)
+        self.last_seen[worker_id] = time.time()
+        self._logger.info('Worker %s registered from %s' % (worker_id, request.get('name', '')))
+        self.condition.notify_all()
+        return (200, {'worker_id': worker_id, 'case_paths': self.case_paths})
+
+    def _get_batch(self, worker_id):
+        if self.done:
+            self.done_workers.add(worker_id)
+            self.condition.notify_all()
+            return {'done': True}
+
+        # smaller batches near the end, so that workers finish at about the same time.
+        # Runs of a case in fresh browsers are given one by one to run at the same time.
+        shard = self.workers[worker_id]
+        if self.fresh:
+            size = 1
         else:
-            self._start(is_firstrun=True)
-            self._run('firstrun')
-            self._run('retry')
+            size = max(1, min(self.BATCH_SIZE, len(self.items) // (2 * len(self.workers))))
+        items = []
+        while self.items and len(items) < size:
+            (index, case_index) = self.items.popleft()
+            (done, cache_key) = self.skip(shard, self.mode, index, case_index, self.total_count)
+            if done:
+                continue
+            self.item_count += 1
+            self.outstanding[self.item_count] = (worker_id, index, case_index, cache_key)
+            items.append([self.item_count, self.mode, index, case_index])
+        self.condition.notify_all()
+        if not items:
+            return {'wait': self.POLL_INTERVAL}
+        return {'items': items, 'total_count': self.total_count, 'fresh': self.fresh}
+
+    def _put(self, worker_id, item_id, case):
+        item = self.outstanding.get(item_id)
+        # the case may have been given to another worker already
+        if not item or item[0] != worker_id:
+            return
+        del self.outstanding[item_id]
+        (_, index, case_index, cache_key) = item
+        self.add(self.workers[worker_id], self.mode, index, case_index, self.total_count, case, cache_key)
+        self.condition.notify_all()
+
+    def _check_workers(self):
+        now = time.time()
+        for worker_id in list(self.workers):
+            if now - self.last_seen[worker_id] <= self.WORKER_TIMEOUT:
+                continue
+            del self.workers[worker_id]
+            del self.last_seen[worker_id]
+            item_ids = [item_id for item_id in self.outstanding if self.outstanding[item_id][0] == worker_id]
+            for item_id in sorted(item_ids, reverse=True):
+                (_, index, case_index, _) = self.outstanding.pop(item_id)
+                self.items.appendleft((index, case_index))
+            self._logger.warning('Worker %s is not heard from for %s seconds, and its %s cases are put back' % (worker_id, self.WORKER_TIMEOUT, len(item_ids)))
+
+
+# Client of the coordinator in a worker. Heartbeats are posted in the
+# background, so that the coordinator knows the worker is alive while a long
+# case runs.
+class WorkerClient(object):
+    # seconds
+    HEARTBEAT_INTERVAL = 10
+    REQUEST_TIMEOUT = 60
+
+    def __init__(self, url, token):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.worker_id = None
+        self.done = False
+        self.closed = threading.Event()
+
+    # Return the case list of the run.
+    def register(self, env, version):
+        response = self._post('/register', {'env': env, 'version': version, 'name': platform.node()})
+        self.worker_id = response['worker_id']
+        thread = threading.Thread(target=self._heartbeat)
+        thread.daemon = True
+        thread.start()
+        return response['case_paths']
+
+    # Return a batch with items of [item id, mode, index in the mode, case
+    # index] and total_count of the mode, or None if the run is done.
+    def get_batch(self):
+        # once a shard is told the run is done, others don't ask again
+        while not self.done:
+            response = self._post('/batch', {'worker_id': self.worker_id})
+            if response.get('done'):
+                self.done = True
+                return None
+            if response.get('items'):
+                return response
+            time.sleep(response.get('wait', Coordinator.POLL_INTERVAL))
+        return None
+
+    def put(self, item_id, case):
+        self._post('/result', {
+            'worker_id': self.worker_id,
+            'item_id': item_id,
+            'case': [case.path, case.status, case.total_count, case.pass_count, case.time],
+        })
 
-        # report
-        self._gen_report()
+    def close(self):
+        self.closed.set()
 
-    # Crash in previous case may only be found in current case, so we just log
-    # the previous result so that we don't need to modify a record.
-    def _append_resume(self, f, index):
-        if index < 1:
+    def _heartbeat(self):
+        while not self.closed.wait(self.HEARTBEAT_INTERVAL):
+            try:
+                self._post('/heartbeat', {'worker_id': self.worker_id})
+            except SystemExit:
+                return
+
+    def _post(self, path, request):
+        data = json.dumps(request).encode('utf-8')
+        try:
+            response = urlopen(Request(self.url + path, data, {'Content-Type': 'application/json', 'X-Coordinator-Token': self.token}), timeout=self.REQUEST_TIMEOUT)
+            return json.loads(response.read().decode('utf-8'))
+        except HTTPError as error:
+            try:
+                msg = json.loads(error.read().decode('utf-8'))['error']
+            except (KeyError, ValueError):
+                msg = str(error)
+            Util.error('Coordinator refused %s: %s' % (path, msg))
+        except (URLError, socket.error) as error:
+            Util.error('Could not reach coordinator at %s: %s' % (self.url, error))
+
+
+# Progress of the run streamed as Server-Sent Events at /events, so that a
+# dashboard can follow many runners without reading their logs. A client
+# joining late gets the progress so far first, and a client too slow to take
+# MAX_QUEUE events is dropped. ETA is derived from the timing history of cases
+# not finished yet, or from the pace so far if there is no history.
+class ProgressStream(object):
+    MAX_QUEUE = 1000
+    # seconds
+    KEEPALIVE_INTERVAL = 15
+    DRAIN_TIMEOUT = 2
+
+    def __init__(self, port, timing_history):
+        self._logger = Util.get_logger()
+        self.timing_history = timing_history
+        self.lock = threading.Lock()
+        self.clients = []
+        self.mode = None
+        self.start_time = time.time()
+        self.total_count = 0
+        self.done_count = 0
+        self.pass_count = 0
+        self.jobs = 1
+        # path -> expected ms of cases not finished yet, and their sum
+        self.estimates = {}
+        self.remaining = None
+        self.server = None
+        if not port:
             return
-        case = self.cur_suite.get_case(index - 1)
-        f.write('%s,%s,%s,%s,%s\n' % (case.path, case.status, case.total_count, case.pass_count, case.time))
 
-    def _crash(self, mode, index):
-        if mode == 'firstrun':
-            crash_case = self.cur_suite.get_case(index - 1)
-        else:
-            crash_case = self.cur_suite.get_case(self.cur_suite.retry_index[index - 1])
-        crash_case.status = Status.CRASH
-        crash_case.total_count = 1
-        crash_case.pass_count = 0
-        self._logger.warning('Case %s crashed' % crash_case.path)
-        self._start()
+        stream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/events':
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                client = stream._add_client()
+                try:
+                    while True:
+                        try:
+                            message = client.get(timeout=stream.KEEPALIVE_INTERVAL)
+                        except queue.Empty:
+                            message = ': keepalive\n\n'
+                        if message is None or client not in stream.clients:
+                            break
+                        self.wfile.write(message.encode('utf-8'))
+                        self.wfile.flush()
+                except (IOError, OSError):
+                    pass
+                finally:
+                    stream._remove_client(client)
+
+            def log_message(self, format, *args):
+                pass
 
-    def _gen_report(self):
-        # summary
-        summary = []
-        path_index = {}
-        for case in self.cur_suite.suite:
-            path = case.path.split('/')[0]
-            if path not in path_index:
-                path_index[path] = len(path_index)
-                case = Case(path, total_count=case.total_count, pass_count=case.pass_count)
-                summary.append(case)
-            else:
-                index = path_index[path]
-                summary[index].total_count += case.total_count
-                summary[index].pass_count += case.pass_count
-        total_count = 0
-        pass_count = 0
-        for case in summary:
-            total_count += case.total_count
-            pass_count += case.pass_count
-        case = Case('all', total_count=total_count, pass_count=pass_count)
-        summary.append(case)
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
 
-        # detail
-        cur_diff_exp_path = Util.diff_list(self.cur_suite.issue_path, self.exp_suite.issue_path)
-        exp_diff_cur_path = Util.diff_list(self.exp_suite.issue_path, self.cur_suite.issue_path)
-        cur_exp_common_path = Util.intersect_list(self.cur_suite.issue_path, self.exp_suite.issue_path)
-        improve_pass_detail = []  # passrate == 100%
-        improve_fail_detail = []  # passrate < 100%
-        regress_detail = []
-        remain_detail = []
-
-        for path in cur_diff_exp_path:
-            cur_case = self.cur_suite.get_case(self.cur_suite.path_index[path])
-            exp_case = Case(path, Status.PASS, cur_case.total_count, cur_case.total_count)
-            regress_detail.append(Change(exp_case, cur_case))
-        for path in exp_diff_cur_path:
-            exp_case = self.exp_suite.get_case(self.exp_suite.path_index[path])
-            if path in self.cur_suite.path_index:
-                cur_case = self.cur_suite.get_case(self.cur_suite.path_index[path])
-                category = improve_pass_detail
-            else:
-                if exp_case.status == Status.FILTER:
-                    status = exp_case.status
-                    category = remain_detail
-                else:  # case was removed
-                    status = Status.NOTEXIST
-                    category = improve_pass_detail
-                cur_case = Case(exp_case.path, status)
-            category.append(Change(exp_case, cur_case))
-        for path in cur_exp_common_path:
-            exp_case = self.exp_suite.get_case(self.exp_suite.path_index[path])
-            cur_case = self.cur_suite.get_case(self.cur_suite.path_index[path])
-            exp_passrate = self._get_passrate(exp_case.total_count, exp_case.pass_count)
-            cur_passrate = self._get_passrate(cur_case.total_count, cur_case.pass_count)
-            if cur_passrate < exp_passrate:
-                category = regress_detail
-            elif cur_passrate > exp_passrate:
-                if cur_passrate == 100:
-                    category = improve_pass_detail
-                else:
-                    category = improve_fail_detail
+        self.server = Server(('', port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._logger.info('Progress is streamed at http://%s:%s/events' % (platform.node(), self.server.server_address[1]))
+
+    # case_paths are those to run in this mode, after done_count cases already done
+    def begin(self, mode, case_paths, done_count, jobs):
+        if not self.server:
+            return
+        estimates = {}
+        for case_path in case_paths:
+            estimates[case_path] = self.timing_history.estimate(case_path, None)
+        known = [estimate for estimate in estimates.values() if estimate is not None]
+        with self.lock:
+            self.mode = mode
+            self.start_time = time.time()
+            self.total_count = done_count + len(case_paths)
+            self.done_count = done_count
+            self.pass_count = 0
+            self.jobs = max(jobs, 1)
+            if known:
+                average = sum(known) / len(known)
+                self.estimates = dict((path, average if estimate is None else estimate) for (path, estimate) in estimates.items())
+                self.remaining = sum(self.estimates[case_path] for case_path in case_paths)
             else:
-                category = remain_detail
-            category.append(Change(exp_case, cur_case))
+                self.estimates = {}
+                self.remaining = None
+            self._publish('begin', self._get_status())
+
+    def start_case(self, shard, case_path):
+        if not self.server:
+            return
+        with self.lock:
+            self._publish('case_start', {'shard': shard.id, 'path': case_path})
 
-        improve_pass_detail = sorted(improve_pass_detail, key=lambda x: x.exp_case.path)
-        improve_fail_detail = sorted(improve_fail_detail, key=lambda x: x.exp_case.path)
-        regress_detail = sorted(regress_detail, key=lambda x: x.exp_case.path)
-        remain_detail = sorted(remain_detail, key=lambda x: x.exp_case.path)
+    def finish_case(self, shard, case):
+        if not self.server:
+            return
+        with self.lock:
+            self.done_count += 1
+            if case.is_pass():
+                self.pass_count += 1
+            if self.remaining is not None:
+                self.remaining = max(self.remaining - self.estimates.get(case.path, 0), 0)
+            data = self._get_status()
+            data.update({
+                'shard': shard.id,
+                'path': case.path,
+                'status': case.status,
+                'case_total': case.total_count,
+                'case_pass': case.pass_count,
+                'time': case.time,
+            })
+            self._publish('case_finish', data)
+
+    # A finished case turned out to crash the browser
+    def crash(self, shard, case_path, was_pass):
+        if not self.server:
+            return
+        with self.lock:
+            if was_pass:
+                self.pass_count -= 1
+            self._publish('crash', {'shard': shard.id, 'path': case_path})
 
-        # top_time
-        top_time = []
-        all_time = sorted(self.cur_suite.suite, key=lambda x: x.time, reverse=True)
-        count = 0
-        for case in all_time:
-            if not case.path:
-                break
-            if count == self.TOP_TIME_COUNT:
-                break
-            top_time.append([case.path, case.time])
-            count += 1
+    def restart(self, shard, standby):
+        if not self.server:
+            return
+        with self.lock:
+            self._publish('restart', {'shard': shard.id, 'standby': standby})
+
+    # A browser is recycled for reason cases or memory, with MB if it's known
+    def recycle(self, shard, reason, case_count, memory):
+        if not self.server:
+            return
+        with self.lock:
+            self._publish('recycle', {'shard': shard.id, 'reason': reason, 'cases': case_count, 'memory': memory})
+
+    def end(self):
+        if not self.server:
+            return
+        with self.lock:
+            self._publish('end', self._get_status())
+            for client in self.clients:
+                try:
+                    client.put_nowait(None)
+                except queue.Full:
+                    pass
+        # let the clients take the last events before the process exits
+        end_time = time.time() + self.DRAIN_TIMEOUT
+        while self.clients and time.time() < end_time:
+            time.sleep(0.05)
+        self.server.shutdown()
+
+    def _get_status(self):
+        elapsed = time.time() - self.start_time
+        if self.remaining is not None:
+            eta = self.remaining / 1000.0 / self.jobs
+        elif self.done_count:
+            eta = elapsed / self.done_count * (self.total_count - self.done_count)
+        else:
+            eta = None
+        return {
+            'mode': self.mode,
+            'total': self.total_count,
+            'done': self.done_count,
+            'pass_rate': Util.get_passrate(self.done_count, self.pass_count),
+            'elapsed': round(elapsed, 1),
+            'eta': eta if eta is None else round(eta, 1),
+        }
+
+    def _add_client(self):
+        client = queue.Queue(self.MAX_QUEUE)
+        with self.lock:
+            client.put_nowait('event: status\ndata: %s\n\n' % json.dumps(self._get_status(), separators=(',', ':')))
+            self.clients.append(client)
+        return client
+
+    def _remove_client(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def _publish(self, event, data):
+        message = 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, separators=(',', ':')))
+        for client in list(self.clients):
+            try:
+                client.put_nowait(message)
+            except queue.Full:
+                self.clients.remove(client)
+
+
+# Report of a run, streamed to disk row by row so that memory does not grow
+# with the number of cases. Sections are written in order: environment,
+# summary, details, retry, top time and phases. Subclasses render the rows
+# they need.
+class Report(object):
+    EXTENSION = ''
+    SECTIONS = ['environment', 'summary', 'details', 'retry', 'top_time', 'phases']
+
+    # artifact_store has images of failing cases, if they are captured
+    def __init__(self, path, artifact_store=None):
+        self.path = path
+        self.artifact_store = artifact_store
+        self.section = None
+        self.file = self._open()
+
+    def begin(self):
+        pass
+
+    def begin_section(self, section):
+        self.section = section
+
+    def add_env(self, name, env):
+        pass
+
+    def add_summary(self, case):
+        pass
+
+    def add_change(self, change):
+        pass
+
+    def add_retry(self, case):
+        pass
+
+    def add_top_time(self, case):
+        pass
+
+    # seconds spent in a phase of cases, in count times
+    def add_phase(self, phase, count, seconds):
+        pass
+
+    def end(self):
+        self.file.close()
+
+    def _open(self):
+        return open(self.path, 'w')
+
+
+class HtmlReport(Report):
+    EXTENSION = 'html'
+    BGCOLOR = {
+        Change.IMPROVE_PASS: '00FF00',
+        Change.IMPROVE_FAIL: 'A6FFA6',
+        Change.REGRESS: 'FF9797',
+        Change.REMAIN: 'FFFF93',
+    }
 
-        # generate html
-        content = '''
+    def begin(self):
+        self.file.write('''
 <html>
   <head>
     <meta http-equiv="content-type" content="text/html; charset=windows-1252">
@@ -1230,36 +2843,20 @@ class Conformance(object):
     </style>
   </head>
   <body>
-        '''
-
-        # environment
-        content += '''
+        ''')
+
+    def begin_section(self, section):
+        if self.section:
+            self._end_table()
+        super(HtmlReport, self).begin_section(section)
+        if section == 'environment':
+            self.file.write('''
     <h2>Environment</h2>
     <table>
       <tbody>
-        '''
-        for env in ['gpu', 'host_os', 'target_os', 'browser']:
-            if env == 'target_os' and self.host_os == self.target_os:
-                continue
-            content += '''
-        <tr bgcolor="#FFFF93"><td align="left" colspan="2"><strong>''' + env.upper() + '''</strong></td></tr>
-            '''
-            env_dict = json.loads(str(eval('self.' + env)))
-            for key in env_dict:
-                content += '''
-        <tr>
-          <td align="left"><strong>''' + str(key) + '''</strong></td>
-          <td align="left">''' + str(env_dict[key]) + '''</td>
-        </tr>
-            '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # summary
-        content += '''
+        ''')
+        elif section == 'summary':
+            self.file.write('''
     <h2>Summary</h2>
     <table>
       <tbody>
@@ -1269,24 +2866,9 @@ class Conformance(object):
           <td align="left"><strong>Pass </strong> </td>
           <td align="left"><strong>Pass Rate %</strong> </td>
         </tr>
-    '''
-        for case in summary:
-            content += '''
-        <tr>
-          <td align="left"> ''' + case.path + ''' </td>
-          <td align="left"> ''' + str(case.total_count) + ''' </td>
-          <td align="left"> ''' + str(case.pass_count) + ''' </td>
-          <td align="left"> ''' + str(self._get_passrate(case.total_count, case.pass_count)) + ''' </td>
-        </tr>
-        '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # detail
-        content += '''
+    ''')
+        elif section == 'details':
+            self.file.write('''
     <h2>Details</h2>
     <table>
       <tbody>
@@ -1301,62 +2883,25 @@ class Conformance(object):
           <td align="left"><strong>Current Pass</strong></td>
           <td align="left"><strong>Current Pass Rate</strong></td>
           <td align="left"><strong>Change</strong></td>
+    ''')
+            if self.artifact_store:
+                self.file.write('''
+          <td align="left"><strong>Artifacts</strong></td>
+    ''')
+            self.file.write('''
         </tr>
-    '''
-
-        for detail in ['improve_pass_detail', 'improve_fail_detail', 'regress_detail', 'remain_detail']:
-            if detail == 'improve_pass_detail':
-                bgcolor = '00FF00'
-            elif detail == 'improve_fail_detail':
-                bgcolor = 'A6FFA6'
-            elif detail == 'regress_detail':
-                bgcolor = 'FF9797'
-            elif detail == 'remain_detail':
-                bgcolor = 'FFFF93'
-            for change in eval(detail):
-                content += '''
-        <tr bgcolor=#''' + bgcolor + '''>
-          <td align="left"> ''' + str(change.exp_case.path) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.status) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.total_count) + '''</td>
-          <td align="left"> ''' + str(change.exp_case.pass_count) + '''</td>
-          <td align="left"> ''' + str(self._get_passrate(change.exp_case.total_count, change.exp_case.pass_count)) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.status) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.total_count) + '''</td>
-          <td align="left"> ''' + str(change.cur_case.pass_count) + '''</td>
-          <td align="left"> ''' + str(self._get_passrate(change.cur_case.total_count, change.cur_case.pass_count)) + '''</td>
-          <td align="left"> ''' + detail.replace('_detail', '') + '''</td>
-        </tr>
-            '''
-
-        content += '''
-      </tbody>
-    </table>
-    '''
-
-        # retry
-        content += '''
+    ''')
+        elif section == 'retry':
+            self.file.write('''
     <h2>Retry Cases</h2>
     <table>
       <tbody>
         <tr>
           <td align="left"> <strong>Case</strong>  </td>
         </tr>
-    '''
-        for index in self.cur_suite.retry_index:
-            content += '''
-        <tr>
-          <td align="left"> ''' + self.cur_suite.get_case(index).path + ''' </td>
-        </tr>
-        '''
-        content += '''
-      </tbody>
-    </table>
-'''
-
-        # top time consuming
-        if self.version != '1.0.3':
-            content += '''
+    ''')
+        elif section == 'top_time':
+            self.file.write('''
     <h2>Top Time Consuming Cases</h2>
     <table>
       <tbody>
@@ -1364,139 +2909,1407 @@ class Conformance(object):
           <td align="left"><strong>Case</strong>  </td>
           <td align="left"><strong>Time (ms)</strong> </td>
         </tr>
-    '''
-            for case in top_time:
-                content += '''
+    ''')
+        elif section == 'phases':
+            self.file.write('''
+    <h2>Phase Time</h2>
+    <table>
+      <tbody>
         <tr>
-          <td align="left"> ''' + case[0] + ''' </td>
-          <td align="left"> ''' + str(case[1]) + ''' </td>
+          <td align="left"><strong>Phase</strong>  </td>
+          <td align="left"><strong>Count</strong> </td>
+          <td align="left"><strong>Total (s)</strong> </td>
+          <td align="left"><strong>Average (ms)</strong> </td>
         </tr>
-        '''
-            content += '''
-      </tbody>
-    </table>
-'''
+    ''')
+
+    def add_env(self, name, env):
+        self.file.write('''
+        <tr bgcolor="#FFFF93"><td align="left" colspan="2"><strong>''' + escape(name.upper()) + '''</strong></td></tr>
+            ''')
+        for key in env:
+            self.file.write('''
+        <tr>
+          <td align="left"><strong>''' + escape(str(key)) + '''</strong></td>
+          <td align="left">''' + escape(str(env[key])) + '''</td>
+        </tr>
+            ''')
+
+    def add_summary(self, case):
+        self.file.write('''
+        <tr>
+          <td align="left"> ''' + escape(case.path) + ''' </td>
+          <td align="left"> ''' + str(case.total_count) + ''' </td>
+          <td align="left"> ''' + str(case.pass_count) + ''' </td>
+          <td align="left"> ''' + str(Util.get_passrate(case.total_count, case.pass_count)) + ''' </td>
+        </tr>
+        ''')
+
+    def add_change(self, change):
+        # cases passing as expected are only listed in the other formats
+        if change.category == Change.PASS:
+            return
+        exp_case = change.exp_case
+        cur_case = change.cur_case
+        self.file.write('''
+        <tr bgcolor=#''' + self.BGCOLOR[change.category] + '''>
+          <td align="left"> ''' + escape(exp_case.path) + '''</td>
+          <td align="left"> ''' + str(exp_case.status) + '''</td>
+          <td align="left"> ''' + str(exp_case.total_count) + '''</td>
+          <td align="left"> ''' + str(exp_case.pass_count) + '''</td>
+          <td align="left"> ''' + str(Util.get_passrate(exp_case.total_count, exp_case.pass_count)) + '''</td>
+          <td align="left"> ''' + str(cur_case.status) + '''</td>
+          <td align="left"> ''' + str(cur_case.total_count) + '''</td>
+          <td align="left"> ''' + str(cur_case.pass_count) + '''</td>
+          <td align="left"> ''' + str(Util.get_passrate(cur_case.total_count, cur_case.pass_count)) + '''</td>
+          <td align="left"> ''' + change.category + '''</td>
+            ''')
+        if self.artifact_store:
+            links = []
+            for digest in self.artifact_store.get(exp_case.path):
+                href = os.path.relpath(self.artifact_store.get_path(digest), os.path.dirname(os.path.abspath(self.path)))
+                links.append('<a href="%s">%s</a>' % (escape(Util.use_slash(href)), digest[:12]))
+            self.file.write('''
+          <td align="left"> ''' + ' '.join(links) + '''</td>
+            ''')
+        self.file.write('''
+        </tr>
+            ''')
+
+    def add_retry(self, case):
+        self.file.write('''
+        <tr>
+          <td align="left"> ''' + escape(case.path) + ''' </td>
+        </tr>
+        ''')
+
+    def add_top_time(self, case):
+        self.file.write('''
+        <tr>
+          <td align="left"> ''' + escape(case.path) + ''' </td>
+          <td align="left"> ''' + str(case.time) + ''' </td>
+        </tr>
+        ''')
 
-        # tail
-        content += '''
+    def add_phase(self, phase, count, seconds):
+        average = seconds * 1000 / count if count else 0
+        self.file.write('''
+        <tr>
+          <td align="left"> ''' + phase + ''' </td>
+          <td align="left"> ''' + str(count) + ''' </td>
+          <td align="left"> ''' + '%.2f' % seconds + ''' </td>
+          <td align="left"> ''' + '%.2f' % average + ''' </td>
+        </tr>
+        ''')
+
+    def end(self):
+        if self.section:
+            self._end_table()
+        self.file.write('''
   </body>
 </html>
+    ''')
+        super(HtmlReport, self).end()
+
+    def _end_table(self):
+        self.file.write('''
+      </tbody>
+    </table>
+    ''')
+
+
+# One JSON object per line, with a "type" of env, summary, case, retry,
+# top_time or phase. All cases are listed, including the ones passing as expected.
+class JsonLinesReport(Report):
+    EXTENSION = 'jsonl'
+
+    def add_env(self, name, env):
+        self._write({'type': 'env', 'name': name, 'env': env})
+
+    def add_summary(self, case):
+        self._write({
+            'type': 'summary',
+            'path': case.path,
+            'total': case.total_count,
+            'pass': case.pass_count,
+        })
+
+    def add_change(self, change):
+        record = {
+            'type': 'case',
+            'path': change.exp_case.path,
+            'change': change.category,
+            'exp_status': change.exp_case.status,
+            'exp_total': change.exp_case.total_count,
+            'exp_pass': change.exp_case.pass_count,
+            'cur_status': change.cur_case.status,
+            'cur_total': change.cur_case.total_count,
+            'cur_pass': change.cur_case.pass_count,
+            'time': change.cur_case.time,
+        }
+        if self.artifact_store:
+            record['artifacts'] = self.artifact_store.get(change.exp_case.path)
+        self._write(record)
+
+    def add_retry(self, case):
+        self._write({'type': 'retry', 'path': case.path})
+
+    def add_top_time(self, case):
+        self._write({'type': 'top_time', 'path': case.path, 'time': case.time})
+
+    def add_phase(self, phase, count, seconds):
+        self._write({'type': 'phase', 'phase': phase, 'count': count, 'seconds': seconds})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+# JUnit XML for CI systems. Every case is a testcase; a regression is a
+# failure, and a case failing as expected is reported as skipped.
+class JUnitReport(Report):
+    EXTENSION = 'xml'
+
+    def begin(self):
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<testsuites>\n  <testsuite name="webgl-conformance">\n')
+
+    def begin_section(self, section):
+        if section == 'environment':
+            self.file.write('    <properties>\n')
+        elif self.section == 'environment':
+            self.file.write('    </properties>\n')
+        super(JUnitReport, self).begin_section(section)
+
+    def add_env(self, name, env):
+        for key in env:
+            self.file.write('      <property name=%s value=%s/>\n' % (quoteattr('%s.%s' % (name, key)), quoteattr(str(env[key]))))
+
+    def add_change(self, change):
+        exp_case = change.exp_case
+        cur_case = change.cur_case
+        dir_name, file_name = os.path.split(exp_case.path)
+        self.file.write('    <testcase classname=%s name=%s time="%.3f"' % (quoteattr(dir_name.replace('/', '.')), quoteattr(file_name), cur_case.time / 1000.0))
+        message = '%s: expected %s %s/%s, got %s %s/%s' % (
+            change.category,
+            exp_case.status, exp_case.pass_count, exp_case.total_count,
+            cur_case.status, cur_case.pass_count, cur_case.total_count
+        )
+        if change.category == Change.REGRESS:
+            self.file.write('>\n      <failure message=%s/>\n    </testcase>\n' % quoteattr(message))
+        elif change.category == Change.REMAIN or cur_case.status == Status.NOTEXIST:
+            self.file.write('>\n      <skipped message=%s/>\n    </testcase>\n' % quoteattr(message))
+        else:
+            self.file.write('/>\n')
+
+    def end(self):
+        if self.section == 'environment':
+            self.file.write('    </properties>\n')
+        self.file.write('  </testsuite>\n</testsuites>\n')
+        super(JUnitReport, self).end()
+
+
+# One row per case with expectation and current result, for spreadsheets.
+class CsvReport(Report):
+    EXTENSION = 'csv'
+    FIELDS = ['path', 'change', 'exp_status', 'exp_total', 'exp_pass', 'cur_status', 'cur_total', 'cur_pass', 'time']
+
+    def begin(self):
+        self.writer = csv.writer(self.file)
+        if self.artifact_store:
+            self.writer.writerow(self.FIELDS + ['artifacts'])
+        else:
+            self.writer.writerow(self.FIELDS)
+
+    def add_change(self, change):
+        exp_case = change.exp_case
+        cur_case = change.cur_case
+        row = [
+            exp_case.path, change.category,
+            exp_case.status, exp_case.total_count, exp_case.pass_count,
+            cur_case.status, cur_case.total_count, cur_case.pass_count,
+            cur_case.time
+        ]
+        if self.artifact_store:
+            row.append(' '.join(self.artifact_store.get(exp_case.path)))
+        self.writer.writerow(row)
+
+    def _open(self):
+        if sys.version_info[0] < 3:
+            return open(self.path, 'wb')
+        return open(self.path, 'w', newline='')
+
+
+# Comparison of stored results of runs, e.g., with driver A and driver B, with
+# no browser. A result is a report in jsonl or csv, or a run in the resume
+# journal given by its id, or by <path of journal>.db:<run id>. Several results
+# joined by +, e.g., parts of a suite run on different machines, are merged
+# into one. Cases of each result are read in the order of path, and
+# merge-joined with the first one.
+class Comparison(object):
+    def __init__(self, resume_file):
+        self.resume_file = resume_file
+
+    # Return cases of the result in the order of path. Results are merged
+    # from the first one, so a case of a later result wins.
+    def read(self, result):
+        results = result.split('+')
+        if len(results) == 1:
+            return self._read_one(result)
+        suite = Suite()
+        for result in results:
+            suite.merge(self._read_one(result))
+        return iter(sorted(suite.suite, key=lambda x: x.path))
+
+    def _read_one(self, result):
+        if result.endswith('.jsonl'):
+            cases = []
+            f = open(result)
+            for line in f:
+                row = json.loads(line)
+                if row['type'] == 'case' and row['cur_status'] != Status.NOTEXIST:
+                    cases.append(Case(row['path'], row['cur_status'], row['cur_total'], row['cur_pass'], row['time']))
+            f.close()
+            cases.sort(key=lambda x: x.path)
+            return iter(cases)
+        elif result.endswith('.csv'):
+            cases = []
+            f = open(result)
+            for row in csv.DictReader(f):
+                if row['cur_status'] != Status.NOTEXIST:
+                    cases.append(Case(row['path'], row['cur_status'], int(row['cur_total']), int(row['cur_pass']), float(row['time'])))
+            f.close()
+            cases.sort(key=lambda x: x.path)
+            return iter(cases)
+
+        if '.db:' in result:
+            (path, run_id) = result.rsplit(':', 1)
+        else:
+            (path, run_id) = (self.resume_file, result)
+        if not os.path.exists(path):
+            Util.error('Could not find resume journal %s' % path)
+        conn = sqlite3.connect(path)
+        if not conn.execute('SELECT id FROM run WHERE id = ?', (run_id,)).fetchone():
+            Util.error('Run %s is not in resume journal %s' % (run_id, path))
+        # the primary key keeps the results of a run in the order of path
+        return (Case(*row) for row in conn.execute('SELECT path, status, total_count, pass_count, time FROM result WHERE run_id = ? ORDER BY path', (run_id,)))
+
+    # Yield a Change for each path in either of exp_cases and cur_cases, both
+    # in the order of path. A case missing on one side takes NOTEXIST there.
+    @staticmethod
+    def join(exp_cases, cur_cases):
+        exp_case = next(exp_cases, None)
+        cur_case = next(cur_cases, None)
+        while exp_case or cur_case:
+            if not cur_case or (exp_case and exp_case.path < cur_case.path):
+                change_exp_case = exp_case
+                change_cur_case = Case(exp_case.path, Status.NOTEXIST)
+                exp_case = next(exp_cases, None)
+            elif not exp_case or cur_case.path < exp_case.path:
+                change_exp_case = Case(cur_case.path, Status.NOTEXIST)
+                change_cur_case = cur_case
+                cur_case = next(cur_cases, None)
+            else:
+                change_exp_case = exp_case
+                change_cur_case = cur_case
+                exp_case = next(exp_cases, None)
+                cur_case = next(cur_cases, None)
+            yield Change(change_exp_case, change_cur_case, Change.get_category(change_exp_case, change_cur_case))
+
+
+class Conformance(object):
+    VERSION_TYPE = {
+        '1.0.0': 'stable',
+        '1.0.1': 'stable',
+        '1.0.2': 'stable',
+        '1.0.3': 'stable',
+        '2.0.0': 'stable',
+        '1.0.4': 'beta',
+        '2.0.1': 'beta',
+    }
+
+    TOP_TIME_COUNT = 20
+    REPORT_FORMATS = {
+        'html': HtmlReport,
+        'jsonl': JsonLinesReport,
+        'junit': JUnitReport,
+        'csv': CsvReport,
+    }
+    # ms, same as the default of webgl-test-harness.js
+    PAGE_TIMEOUT = 20000
+    PAGE_SUBTEST_COUNT = 100000
+    # cases sensitive to timing or to other pages using the GPU
+    SERIAL_CASES = 'context-lost|context-loss|lose-context|timer|video|stress|performance'
+    ARTIFACT_TYPES = ['screenshot', 'canvas']
+    # most canvases of a page to read back
+    ARTIFACT_CANVAS_COUNT = 4
+    # seconds between checks of the harness page while waiting for the result to be posted
+    POLL_INTERVAL = 0.5
+    # browsers started for a case before giving up
+    MAX_CASE_TRIES = 3
+
+    # Installed into the harness page so that test pages loaded into its iframe
+    # report to us instead of the harness. Every subtest is recorded as one
+    # status character (Subtest.PASS, etc.) and its message. Once the page
+    # finishes, its token is posted to the collector and the result is pulled
+    # with getResult(). The latest console messages of pages are kept in a ring
+    # buffer of logCount entries, and only pulled with getLogs() if the page
+    # did not pass. Pages started while others are running are loaded into
+    # more iframes like the first one. Only the sdk harness has an iframe with
+    # id test-iframe, so an iframe is added to other harnesses. Pages of 1.0.0
+    # and 1.0.1 report without their url, which is then the only running page.
+    HOST_SCRIPT = '''
+        var timeoutDelay = arguments[0];
+        var subtestCount = arguments[1];
+        var collectorUrl = arguments[2];
+        var logCount = arguments[3];
+        var logLength = 1000;
+        // ms between looks for the window of a new page to hook its console
+        var hookDelay = 10;
+        var anchor = document.createElement('a');
+        var iframe = document.getElementById('test-iframe');
+        if (!iframe) {
+            iframe = document.createElement('iframe');
+            iframe.setAttribute('scrolling', 'yes');
+            iframe.style.cssText = 'display: block; width: 100%; height: 600px;';
+            document.body.insertBefore(iframe, document.body.firstChild);
+        }
+        var host = window.conformanceHost = {
+            iframe: iframe,
+            // iframes pages run in, each with its last page
+            iframes: [],
+            // pathname -> running page
+            pages: {},
+            // token -> result of finished page
+            results: {},
+            // [token, time, level, message] of latest console messages
+            logs: [],
+        };
+        host.iframes.push(host.iframe);
+
+        host.run = function(url, token) {
+            anchor.href = url;
+            var page = {
+                token: token,
+                pathname: anchor.pathname,
+                counts: {P: 0, F: 0, S: 0, T: 0},
+                statuses: [],
+                messages: [],
+                startTime: Date.now(),
+                finished: false,
+            };
+            host.pages[page.pathname] = page;
+            host.bumpTimeout(page);
+            page.iframe = host.getIframe();
+            page.iframe.page = page;
+            page.iframe.src = url;
+            host.hookConsole(page);
+        };
+
+        host.getIframe = function() {
+            for (var i = 0; i < host.iframes.length; ++i) {
+                var page = host.iframes[i].page;
+                if (!page || page.finished) {
+                    return host.iframes[i];
+                }
+            }
+            var last = host.iframes[host.iframes.length - 1];
+            var iframe = document.createElement('iframe');
+            iframe.className = host.iframe.className;
+            iframe.style.cssText = host.iframe.style.cssText;
+            iframe.width = host.iframe.width;
+            iframe.height = host.iframe.height;
+            last.parentNode.insertBefore(iframe, last.nextSibling);
+            host.iframes.push(iframe);
+            return iframe;
+        };
+
+        // Contents of the canvases of a page still in its iframe, as data URLs of PNG
+        host.readCanvases = function(count, token) {
+            var urls = [];
+            host.iframes.forEach(function(iframe) {
+                if (!iframe.page || iframe.page.token != token) {
+                    return;
+                }
+                try {
+                    var canvases = iframe.contentDocument.getElementsByTagName('canvas');
+                    for (var i = 0; i < canvases.length && urls.length < count; ++i) {
+                        if (canvases[i].width && canvases[i].height) {
+                            urls.push(canvases[i].toDataURL('image/png'));
+                        }
+                    }
+                } catch (e) {
+                }
+            });
+            return urls;
+        };
+
+        host.getLogs = function(token) {
+            return host.logs.filter(function(entry) {
+                return entry[0] == token;
+            }).map(function(entry) {
+                return [entry[1], 'console', entry[2], entry[3]];
+            });
+        };
+
+        host.log = function(token, level, args) {
+            var message = Array.prototype.map.call(args, function(arg) {
+                if (arg && arg.stack) {
+                    return String(arg.stack);
+                }
+                if (typeof arg == 'object' && arg !== null) {
+                    try {
+                        return JSON.stringify(arg);
+                    } catch (e) {
+                    }
+                }
+                return String(arg);
+            }).join(' ');
+            if (message.length > logLength) {
+                message = message.substring(0, logLength) + '...';
+            }
+            host.logs.push([token, Date.now(), level, message]);
+            if (host.logs.length > logCount) {
+                host.logs.shift();
+            }
+        };
+
+        // The console of the page is hooked soon after its window replaces the
+        // previous one, so that messages before a crash or hang are kept too.
+        // The window is looked for every hookDelay ms until it's hooked or the
+        // page finishes, so that the page under test isn't slowed by spinning.
+        host.hookConsole = function(page) {
+            if (!logCount) {
+                return;
+            }
+            var timer = setInterval(function() {
+                if (page.finished || host.hookWindow(page)) {
+                    clearInterval(timer);
+                }
+            }, hookDelay);
+        };
+
+        // Whether the console of the window of the page is hooked
+        host.hookWindow = function(page) {
+            var win = null;
+            try {
+                win = page.iframe.contentWindow;
+                if (win.location.pathname != page.pathname) {
+                    win = null;
+                }
+            } catch (e) {
+                win = null;
+            }
+            if (!win) {
+                return false;
+            }
+            if (win.conformanceToken) {
+                return win.conformanceToken == page.token;
+            }
+            win.conformanceToken = page.token;
+            ['log', 'info', 'warn', 'error', 'debug'].forEach(function(level) {
+                var original = win.console[level];
+                win.console[level] = function() {
+                    host.log(page.token, level, arguments);
+                    return original.apply(this, arguments);
+                };
+            });
+            win.addEventListener('error', function(event) {
+                host.log(page.token, 'error', [event.message + ' at ' + event.filename + ':' + event.lineno]);
+            });
+            win.addEventListener('unhandledrejection', function(event) {
+                host.log(page.token, 'error', ['Unhandled rejection:', event.reason]);
+            });
+            return true;
+        };
+
+        host.getResult = function(token) {
+            var result = host.results[token];
+            if (!result) {
+                return null;
+            }
+            delete host.results[token];
+            return result;
+        };
+
+        host.bumpTimeout = function(page) {
+            var isArmed = page.timeoutAt;
+            page.timeoutAt = performance.now() + timeoutDelay;
+            if (isArmed) {
+                return;
+            }
+            var watchdog = function() {
+                if (!page.timeoutAt) {
+                    return;
+                }
+                var remaining = page.timeoutAt - performance.now();
+                if (remaining <= 0) {
+                    host.finishPage(page, undefined);
+                } else {
+                    setTimeout(watchdog, remaining);
+                }
+            };
+            setTimeout(watchdog, timeoutDelay);
+        };
+
+        host.finishPage = function(page, success) {
+            if (page.finished) {
+                return;
+            }
+            page.finished = true;
+            page.timeoutAt = null;
+            delete host.pages[page.pathname];
+
+            host.results[page.token] = {
+                timedOut: success === undefined,
+                time: Date.now() - page.startTime,
+                counts: page.counts,
+                statuses: page.statuses.join(''),
+                messages: page.messages,
+            };
+            if (collectorUrl) {
+                var xhr = new XMLHttpRequest();
+                xhr.open('POST', collectorUrl, true);
+                xhr.setRequestHeader('Content-Type', 'text/plain');
+                xhr.send(JSON.stringify({token: page.token}));
+            }
+        };
+
+        host.getPage = function(url) {
+            if (url !== undefined) {
+                return host.pages[url];
+            }
+            var pathnames = Object.keys(host.pages);
+            return pathnames.length == 1 ? host.pages[pathnames[0]] : undefined;
+        };
+
+        window.webglTestHarness = {
+            reportResults: function(url, success, msg, skipped) {
+                // reportResults(success, msg) of 1.0.0 and 1.0.1
+                if (typeof url != 'string') {
+                    skipped = undefined;
+                    msg = success;
+                    success = url;
+                    url = undefined;
+                }
+                var page = host.getPage(url);
+                if (!page || page.finished) {
+                    return;
+                }
+                var status;
+                if (success === undefined) {
+                    status = 'T';
+                } else if (skipped) {
+                    status = 'S';
+                } else if (success) {
+                    status = 'P';
+                } else {
+                    status = 'F';
+                }
+                ++page.counts[status];
+                // Some pages have millions of subtests, and only their counts are kept beyond the limit.
+                if (page.statuses.length < subtestCount) {
+                    page.statuses.push(status);
+                    page.messages.push(msg);
+                }
+                host.bumpTimeout(page);
+            },
+            notifyFinished: function(url) {
+                var page = host.getPage(url);
+                if (page) {
+                    host.finishPage(page, true);
+                }
+            },
+        };
     '''
-        f = open(self.result_file, 'w')
-        f.write(content)
-        f.close()
 
-    def _get_case_elements(self):
-        if re.match('all', self.args.suite):
-            suite = self.args.suite
+    def __init__(self):
+        # argument
+        parser = argparse.ArgumentParser(description='Khronos WebGL Conformance Test Script', formatter_class=argparse.ArgumentDefaultsHelpFormatter, epilog='''
+    examples:
+      python %(prog)s --browser_name chrome --version 2.0.1 --suite conformance/attribs
+    ''')
+        parser.add_argument('--browser-name', dest='browser_name', help='name of browser')
+        parser.add_argument('--browser-options', dest='browser_options', help='extra options of browser, split by ","')
+        parser.add_argument('--browser-path', dest='browser_path', help='path of browser')
+        parser.add_argument('--webdriver-path', dest='webdriver_path', help='path of webdriver')
+        parser.add_argument('--version', dest='version', help='WebGL conformance test version', default='2.0.1')
+        parser.add_argument('--url', dest='url', help='url for website other than default Khronos WebGL CTS')
+        parser.add_argument('--suite', dest='suite', help='instead of whole suite, we may test specific cases, e.g., conformance/attibs or "conformance/attribs/gl-bindAttribLocation-matrix.html"', default='all')
+        parser.add_argument('--test-dir', dest='test_dir', help='local directory with 00_test_list.txt of the suite, e.g., ../sdk/tests. By default, it is derived from version')
+        parser.add_argument('--min-version', dest='min_version', help='only test cases marked with --min-version at this version or greater')
+        parser.add_argument('--max-version', dest='max_version', help='only test cases marked with --max-version at this version or less')
+        parser.add_argument('--expectations', dest='expectations', help='file of expectations. By default, expectations.txt beside this script is used if it exists')
+        parser.add_argument('--os-name', dest='os_name', help='OS to run test on')
+        parser.add_argument('--device-id', dest='device_id', help='id of mobile device to run test on. Ids split by "," or "all" to spread cases across several devices in parallel. Devices of different models are run in processes of their own, with a report for each model')
+        parser.add_argument('--device-model', dest='device_model', help='model of the devices of --device-id, added to the names of logs and reports. It is set for the process of each model when devices of several models are used')
+        parser.add_argument('--refresh-fingerprint', dest='refresh_fingerprint', help='detect GPU again instead of using the info cached in log/fingerprint.json', action='store_true')
+        parser.add_argument('--mesa-dir', dest='mesa_dir', help='directory of Mesa')
+        parser.add_argument('--gles', dest='gles', help='gles', action='store_true')
+        parser.add_argument('--logging-level', dest='logging_level', help='level of logging', default=logging.INFO)
+        parser.add_argument('--timeout', dest='timeout', help='timeout seconds for each test', type=int, default=60)
+        parser.add_argument('--timeout-factor', dest='timeout_factor', help='derive timeout of each case from history, as the 99th percentile of its past durations times this factor. 0 to always use --timeout', type=float, default=0)
+        parser.add_argument('--min-timeout', dest='min_timeout', help='least timeout seconds derived from history', type=int, default=10)
+        parser.add_argument('--max-timeout', dest='max_timeout', help='most timeout seconds derived from history', type=int, default=300)
+        parser.add_argument('--tools', dest='open_tools', help='show the developer tools for the browser', action='store_true')
+        parser.add_argument('--report-formats', dest='report_formats', help='formats of report, split by ",", from html, jsonl, junit and csv', default='html')
+        parser.add_argument('--run-id', dest='run_id', help='id of the run to resume, e.g., from log/resume.db copied from another machine. By default, the last unfinished run of the same cases is resumed')
+        parser.add_argument('--cache', dest='cache', help='reuse results of cases whose page, files used by it, GPU, OS and browser are all unchanged since they were run', action='store_true')
+        parser.add_argument('--retry-count', dest='retry_count', help='number of runs of each unexpected failure in retry, each in a fresh browser and all at the same time', type=int, default=1)
+        parser.add_argument('--quarantine', dest='quarantine', help='expect cases to fail if at least this fraction of their past retry runs passed, e.g., 0.5, so that they are not retried, except in one of every %s runs' % FlakeHistory.QUARANTINE_RUNS, type=float, default=0)
+        parser.add_argument('--jobs', dest='jobs', help='number of browser sessions to run cases in parallel', type=int, default=1)
+        parser.add_argument('--compare', dest='compare', help='instead of running cases, compare stored results with the first one, each as a report in jsonl or csv, a run id in log/resume.db, or <path>.db:<run id>, and several of them joined by + to merge them', nargs='+')
+        parser.add_argument('--artifacts', dest='artifacts', help='images captured for cases that do not pass, split by ",", from screenshot and canvas. They are stored by digest in --artifact-dir, and linked from reports')
+        parser.add_argument('--artifact-dir', dest='artifact_dir', help='directory of images captured with --artifacts, shared by runs so that each image is stored once', default='result/artifacts')
+        parser.add_argument('--page-concurrency', dest='page_concurrency', help='pages run at the same time in each browser, in iframes of the harness page. Cases matching --serial-cases or flaky in the past are still run alone', type=int, default=1)
+        parser.add_argument('--serial-cases', dest='serial_cases', help='regular expression of timing-sensitive cases run alone with --page-concurrency', default=self.SERIAL_CASES)
+        parser.add_argument('--recycle-cases', dest='recycle_cases', help='start a new browser session after this number of cases in one session. 0 to not limit', type=int, default=0)
+        parser.add_argument('--recycle-memory', dest='recycle_memory', help='start a new browser session once the browser uses more than this number of MB, measured every --memory-interval cases. It is the resident memory of all browser processes if psutil is installed and the browser is local, otherwise the JS heap in performance.memory. 0 to not limit', type=int, default=0)
+        parser.add_argument('--memory-interval', dest='memory_interval', help='cases between two measurements of browser memory for --recycle-memory', type=int, default=10)
+        parser.add_argument('--case-log-count', dest='case_log_count', help='latest console messages of test pages kept in each browser session, and written for cases that do not pass. 0 to not capture them', type=int, default=200)
+        parser.add_argument('--progress-port', dest='progress_port', help='stream progress of the run as Server-Sent Events at http://<host>:<port>/events', type=int, default=0)
+        parser.add_argument('--serve-port', dest='serve_port', help='serve cases on this port to workers started with --coordinator, instead of running them, as the coordinator of a run across machines with identical GPUs', type=int, default=0)
+        parser.add_argument('--coordinator-bind', dest='coordinator_bind', help='address the coordinator serves workers at, e.g., 0.0.0.0 for workers on other machines', default='127.0.0.1')
+        parser.add_argument('--coordinator', dest='coordinator', help='url of the coordinator, e.g., http://host:port, to run its cases as a worker')
+        parser.add_argument('--coordinator-token', dest='coordinator_token', help='token shared by the coordinator and its workers, which the coordinator generates and logs if not given')
+        parser.add_argument('--standby', dest='standby', help='number of browsers launched ahead of time to replace crashed or hung ones at once', type=int, default=0)
+
+        debug_group = parser.add_argument_group('debug')
+        debug_group.add_argument('--fixed-time', dest='fixed_time', help='fixed time', action='store_true')
+        debug_group.add_argument('--fake-cases', dest='fake_cases', help='run this number of synthetic cases in fake browsers, to measure the overhead of the script', type=int, default=0)
+        debug_group.add_argument('--fake-latency', dest='fake_latency', help='median ms of synthetic cases', type=float, default=20)
+        debug_group.add_argument('--fake-jitter', dest='fake_jitter', help='sigma of the log-normal distribution of durations of synthetic cases', type=float, default=0.5)
+        debug_group.add_argument('--fake-seed', dest='fake_seed', help='seed of crashes and durations of synthetic cases, the same for the same seed', type=int, default=0)
+        debug_group.add_argument('--dryrun-test', dest='dryrun_test', help='dryrun test', action='store_true')
+        args = parser.parse_args()
+
+        # timestamp
+        if args.fixed_time:
+            self.timestamp = Util.get_datetime(format='%Y%m%d')
+        else:
+            self.timestamp = Util.get_datetime()
+        # processes of device models run at the same time don't share files
+        self.device_tag = ''
+        if args.device_model:
+            self.device_tag = '-' + re.sub(r'[^\w.-]', '_', args.device_model)
+        self.timestamp += self.device_tag
+        # workers on the same machine don't share files either
+        if args.coordinator:
+            self.timestamp += '-worker-%s' % os.getpid()
+
+        # log
+        work_dir = Util.use_slash(sys.path[0])
+        os.chdir(work_dir)
+        self.log_dir = 'log'
+        Util.ensure_dir(self.log_dir)
+        self.log_file = '%s/%s.log' % (self.log_dir, self.timestamp)
+        Util.ensure_nofile(self.log_file)
+        Util.set_logger(self.log_file, args.logging_level)
+        self._logger = Util.get_logger()
+
+        # device
+        if args.os_name == 'android':
+            mobile_devices = AndroidDevices()
+        elif args.os_name == 'ios':
+            mobile_devices = iOSDevices()
         else:
-            suite = 'all/' + self.args.suite
+            mobile_devices = None
+        self.mobile_devices = []
+        self.mobile_device = None
+        if mobile_devices:
+            self.mobile_devices = mobile_devices.get_devices(args.device_id)
+            self.mobile_device = self.mobile_devices[0]
+            if len(self.mobile_devices) > 1:
+                groups = mobile_devices.group_by_model(self.mobile_devices)
+                if len(groups) > 1:
+                    self._fan_out(args, work_dir, groups)
+                    return
+        self.resume_file = '%s/resume.db' % self.log_dir
 
-        if re.search('.html$', suite):
-            folder_name = os.path.dirname(suite)
-            case_name = suite.split('/')[-1]
+        # result
+        self.result_dir = 'result'
+        Util.ensure_dir(self.result_dir)
+        self.report_formats = args.report_formats.split(',')
+        for report_format in self.report_formats:
+            if report_format not in self.REPORT_FORMATS:
+                Util.error('Report format %s is not supported, use one of %s' % (report_format, ','.join(sorted(self.REPORT_FORMATS))))
+        if args.compare:
+            self._compare(args.compare)
+            return
+        if args.artifacts:
+            self.artifact_types = args.artifacts.split(',')
+            for artifact_type in self.artifact_types:
+                if artifact_type not in self.ARTIFACT_TYPES:
+                    Util.error('Artifact %s is not supported, use one of %s' % (artifact_type, ','.join(self.ARTIFACT_TYPES)))
+            self.artifact_store = ArtifactStore(args.artifact_dir)
         else:
-            folder_name = suite
-            case_name = ''
-
-        folder_name_elements = self.driver.find_elements(By.CLASS_NAME, 'folderName')
-        for folder_name_element in folder_name_elements:
-            if folder_name_element.text == folder_name:
-                tmp_case_elements = folder_name_element.find_elements(By.XPATH, '../../..//*[@class="testpage"]')
-                if not case_name:
-                    case_elements = tmp_case_elements
-                    break
-                for case_element in tmp_case_elements:
-                    if '%s/%s' % ('all', case_element.find_element(By.XPATH, './div/a').text) == suite:
-                        case_elements = [case_element]
-                        break
-                if case_elements:
-                    break
+            self.artifact_types = []
+            self.artifact_store = None
+
+        self.resume_journal = ResumeJournal(self.resume_file)
+        self.timing_history = TimingHistory('%s/history.db' % self.log_dir)
+        self.flake_history = FlakeHistory('%s/history.db' % self.log_dir)
+        self.progress = ProgressStream(args.progress_port, self.timing_history)
+        self.page_concurrency = max(args.page_concurrency, 1)
+        if self.page_concurrency > 1:
+            self.serial_pattern = re.compile(args.serial_cases)
+            self.flaky_paths = set(self.flake_history.get_flaky_paths())
+        self.run_id = args.run_id
+
+        self.subtest_store = SubtestStore('%s/%s-subtests.jsonl.gz' % (self.result_dir, self.timestamp))
+        self.case_log_count = args.case_log_count
+        if self.case_log_count:
+            self.case_log_store = CaseLogStore('%s/%s-logs.jsonl.gz' % (self.result_dir, self.timestamp))
         else:
-            Util.error('Could not find suite %s' % suite)
+            self.case_log_store = None
+        self.tracer = Tracer('%s/%s-trace.json' % (self.result_dir, self.timestamp))
 
-        self.case_elements = case_elements
+        # OS
+        self.host_os = HostOS()
+        if args.os_name == 'android':
+            self.target_os = AndroidOS(self.mobile_device)
+        elif args.os_name == 'ios':
+            self.target_os = OS("ios")
+        else:
+            self.target_os = self.host_os
 
-    def _get_passrate(self, total, passed):
-        if float(total) == 0:
-            return 0
-        return float('%.2f' % (float(passed) / float(total) * 100))
+        self.fingerprint_cache = FingerprintCache('%s/fingerprint%s.json' % (self.log_dir, self.device_tag), self.target_os, self.mobile_device, args.refresh_fingerprint)
+        self.driver_stamp = self.fingerprint_cache.driver_stamp
 
-    def _get_result(self, text):
-        # passed includes both results of passed and skipped
-        if self.version == '1.0.3':
-            match = re.search(r'(\d+) of (\d+) (.+)', text)
-            if match:
-                total = int(match.group(2))
-                passed = int(match.group(1))
+        # browser
+        if args.browser_name:
+            browser_name = args.browser_name
+        elif self.target_os.is_cros() or args.fake_cases or args.serve_port:
+            # the coordinator takes the browser of workers
+            browser_name = 'chrome'
+        else:
+            Util.error('Please designate browser name')
+        if args.browser_options:
+            browser_options = args.browser_options.split(',')
+        else:
+            browser_options = []
+
+        if args.gles and self.target_os.is_linux() and 'chrome' in browser_name:
+            browser_options.append('--use-gl=egl')
+
+        # shards, one for each device if there are several
+        if args.jobs < 1:
+            Util.error('The number of jobs should be at least 1')
+        if args.standby < 0:
+            Util.error('The number of standby browsers should not be negative')
+        if args.serve_port and args.coordinator:
+            Util.error('A process can not be the coordinator and a worker at the same time')
+        if args.coordinator and not args.coordinator_token:
+            Util.error('A worker needs --coordinator-token, as logged by the coordinator')
+        if args.serve_port:
+            # the coordinator runs no browser, and each worker is a shard of it
+            job_count = 0
+            browser_count = 0
+        elif len(self.mobile_devices) > 1:
+            if args.jobs > 1 or args.standby:
+                Util.error('Parallel jobs and standby browsers are not supported with several devices, which run a job each')
+            job_count = len(self.mobile_devices)
+            browser_count = job_count
+        else:
+            job_count = args.jobs
+            browser_count = args.jobs + args.standby
+            if browser_count > 1 and (self.target_os.is_android() or self.target_os.is_ios() or self.target_os.is_cros() or 'safari' in browser_name):
+                Util.error('Parallel jobs and standby browsers are not supported with %s on %s' % (browser_name, self.target_os.name))
+            # runs of a case in retry are done at the same time, with more browsers if needed
+            if not args.coordinator and not (self.target_os.is_android() or self.target_os.is_ios() or self.target_os.is_cros() or 'safari' in browser_name):
+                browser_count += max(args.retry_count - job_count, 0)
+
+        # standby browsers follow the ones of shards, and then browsers of shards
+        # only used in retry, each with its own user data dir
+        self.shards = []
+        self.standby_browsers = []
+        self.retry_shards = []
+        for browser_id in range(browser_count):
+            shard_options = list(browser_options)
+            user_data_dir = None
+            if 'chrome' in browser_name and not self.target_os.is_android() and not self.target_os.is_cros():
+                user_data_dir = 'user-data-dir-%s' % self.target_os.username
+                if args.coordinator:
+                    user_data_dir += '-worker-%s' % os.getpid()
+                if browser_count > 1:
+                    user_data_dir += '-%s' % browser_id
+                if args.coordinator:
+                    atexit.register(Util.ensure_nodir, user_data_dir)
+                shard_options.append('--user-data-dir=%s' % (work_dir + '/' + user_data_dir))
+                Util.ensure_nodir(user_data_dir)
+                Util.ensure_dir(user_data_dir)
+            shard_browser = Browser(name=browser_name, path=args.browser_path, options=shard_options, os=self.target_os)
+            if browser_id < job_count:
+                if len(self.mobile_devices) > 1:
+                    shard_device = self.mobile_devices[browser_id]
+                else:
+                    shard_device = self.mobile_device
+                self.shards.append(Shard(browser_id, shard_browser, user_data_dir, shard_device))
+            elif browser_id < job_count + args.standby:
+                self.standby_browsers.append(shard_browser)
+            else:
+                self.retry_shards.append(Shard(browser_id, shard_browser, user_data_dir, self.mobile_device))
+        self.standby_pool = None
+
+        self.browser = self.shards[0].browser if self.shards else None
+        self.lock = threading.Lock()
+        self.aborted = False
+
+        # others
+        self.webdriver_path = args.webdriver_path
+        self.args = args
+        self.timeout = args.timeout
+        self.retry_count = args.retry_count
+        self.recycle_cases = args.recycle_cases
+        self.recycle_memory = args.recycle_memory
+        self.memory_interval = max(args.memory_interval, 1)
+        # (time, shard id, reason, cases in session, MB or None) of each recycle
+        self.recycles = []
+        if self.retry_count < 1:
+            Util.error('Cases should be run at least once in retry')
+        self.quarantine = args.quarantine
+        self.timeout_factor = args.timeout_factor
+        self.min_timeout = args.min_timeout
+        self.max_timeout = args.max_timeout
+        if self.timeout_factor < 0 or self.min_timeout > self.max_timeout:
+            Util.error('Timeout factor should not be negative, and min timeout should not be greater than max timeout')
+        self.open_tools = args.open_tools
+
+        # url
+        self.version = args.version
+        # pages of these versions report without their url, so only one may run at a time
+        if self.version in ['1.0.0', '1.0.1'] and self.page_concurrency > 1:
+            self._logger.warning('Pages of version %s are run one at a time' % self.version)
+            self.page_concurrency = 1
+        if args.url:
+            self.url = args.url
+        else:
+            self.url = 'https://www.khronos.org/registry/webgl'
+            if self.version not in self.VERSION_TYPE:
+                Util.error('The version %s is not supported' % self.version)
+            type = self.VERSION_TYPE[self.version]
+            if type == 'stable':
+                self.url += '/conformance-suites/%s/webgl-conformance-tests.html' % self.version
+            elif type == 'beta':
+                self.url += '/sdk/tests/webgl-conformance-tests.html?version=%s' % self.version
+
+        # fake
+        self.fake_cases = args.fake_cases
+        if self.fake_cases:
+            self.webdriver_class = FakeWebdriver
+            FakeWebdriver.latency = args.fake_latency
+            FakeWebdriver.jitter = args.fake_jitter
+            FakeWebdriver.seed = args.fake_seed
+            self.url = 'fake://webgl-conformance-tests.html'
+        else:
+            self.webdriver_class = Webdriver
+
+        # case
+        timer = Timer(use_ms=True)
+        if self.fake_cases:
+            test_dir = '%s/fake-tests%s' % (self.log_dir, self.device_tag)
+            # a worker takes the case list from the coordinator
+            if not args.coordinator:
+                FakeDriver.create_test_list(test_dir, self.fake_cases)
+        elif args.test_dir:
+            test_dir = Util.use_slash(args.test_dir)
+        elif self.VERSION_TYPE.get(self.version) == 'stable':
+            test_dir = '../conformance-suites/%s' % self.version
+        else:
+            test_dir = '../sdk/tests'
+        self.test_dir = test_dir
+        if args.coordinator:
+            # the case list is given by the coordinator
+            self.case_paths = []
+        else:
+            self.case_paths = TestList(test_dir, self.version, args.min_version, args.max_version).get_paths(args.suite)
+        timer.stop()
+        list_time = timer.diff()
+        self.result_cache = None
+        self.webgl_version = self.version.split('.')[0]
+        self.coordinator = None
+        self.worker = None
+
+        # expectation
+        if args.expectations:
+            self.expectations = Expectations(Util.use_slash(args.expectations), self.version)
+        elif os.path.exists('expectations.txt'):
+            self.expectations = Expectations('expectations.txt', self.version)
+        else:
+            self.expectations = Expectations()
+
+        # collector
+        self.collector = ResultCollector()
+        if self.target_os.is_android():
+            # let the browser on device reach the collector on host
+            cmds = [Cmd('adb -s %s reverse tcp:%s tcp:%s' % (mobile_device.id, self.collector.port, self.collector.port), wait=False) for mobile_device in self.mobile_devices]
+            for cmd in cmds:
+                cmd.wait()
+
+        # runtime env
+        mesa_dir = args.mesa_dir
+        if self.target_os.is_linux() and mesa_dir:
+            Util.set_env('LD_LIBRARY_PATH', mesa_dir + '/lib')
+            Util.set_env('LIBGL_DRIVERS_PATH', mesa_dir + '/lib/dri')
+
+        if args.gles and self.target_os.is_linux() and self.gpu.is_intel():
+            pkg = 'libgles-mesa'
+            if not Util.has_pkg(pkg):
+                Util.error('Package %s is not installed' % pkg)
+        if args.gles and self.gpu.is_nvidia():
+            Util.set_env('LD_LIBRARY_PATH', '/usr/lib/nvidia-' + self.gpu.version.split('.')[0])
+
+        # test
+        timer = Timer(use_ms=True)
+        if args.dryrun_test:
+            self.exp_suite = Suite()
+            self.cur_suite = Suite(self.exp_suite)
+            self.driver = None
+            self.gpu = self.gpus.get_active(self.driver)
+        elif args.serve_port:
+            self.coordinator = Coordinator(args.serve_port, self.case_paths, self.version, self._register_worker, self._skip_case, self._add_remote_case, args.coordinator_bind, args.coordinator_token)
+            self._logger.info('Wait for workers at %s:%s with --coordinator-token %s' % (args.coordinator_bind, self.coordinator.port, self.coordinator.token))
+            self._set_env(self.coordinator.wait_env())
+            self._load_expectations()
+            self._open_cache(args)
+            self._run('firstrun')
+            self._run('retry')
+            self.coordinator.finish()
+        else:
+            self._start(self.shards[0], is_firstrun=True)
+            if self.standby_browsers:
+                self.standby_pool = StandbyPool(self.standby_browsers, self._launch)
+            if args.coordinator:
+                self._run_worker(args.coordinator, args.coordinator_token)
             else:
-                total = 1
-                passed = 0
-            skipped = 0
-            time = 0
-            if total == passed + skipped:
-                status = Status.PASS
+                self._open_cache(args)
+                self._run('firstrun')
+                self._run('retry')
+            if self.standby_pool:
+                self.standby_pool.close()
+        timer.stop()
+        run_time = timer.diff()
+        self.progress.end()
+        self.subtest_store.close()
+        if self.case_log_store:
+            self.case_log_store.close()
+        self.tracer.close()
+        self.resume_journal.close()
+        self.timing_history.close()
+        self.flake_history.close()
+        if self.result_cache:
+            self.result_cache.close()
+        if self.artifact_store:
+            self._logger.info('Artifacts: %s images written, %s already in %s' % (self.artifact_store.write_count, self.artifact_store.dup_count, self.artifact_store.path))
+
+        if self.worker:
+            self._logger.info('Worker finished all cases given by the coordinator')
+            return
+
+        # report
+        timer = Timer(use_ms=True)
+        self._gen_report()
+        timer.stop()
+
+        if self.fake_cases and not self.coordinator:
+            # time of the run not spent in fake cases is the overhead of the script,
+            # with each of --page-concurrency pages in a browser counted on its own
+            overhead = run_time.total_seconds() * len(self.shards) * self.page_concurrency - FakeDriver.case_time
+            self._logger.info('Benchmark of %s fake cases with %s jobs: list %s, run %s, report %s, fake cases %.3f seconds, overhead %.3f ms per case' % (
+                len(self.case_paths), len(self.shards), list_time, run_time, timer.diff(), FakeDriver.case_time, overhead * 1000 / len(self.case_paths)
+            ))
+
+    # Compare each of results after the first one with it, into a report of its own
+    def _compare(self, results):
+        if len(results) < 2:
+            Util.error('At least two results are needed to compare')
+        comparison = Comparison(self.resume_file)
+        for (index, result) in enumerate(results[1:]):
+            timer = Timer(use_ms=True)
+            # results are joined again for each category rather than keeping all changes
+            counts = dict((category, 0) for category in Change.CATEGORIES)
+            for change in Comparison.join(comparison.read(results[0]), comparison.read(result)):
+                counts[change.category] += 1
+
+            reports = []
+            for report_format in self.report_formats:
+                report_class = self.REPORT_FORMATS[report_format]
+                reports.append(report_class('%s/%s-compare-%s.%s' % (self.result_dir, self.timestamp, index + 1, report_class.EXTENSION)))
+            for report in reports:
+                report.begin()
+                report.begin_section('environment')
+                report.add_env('comparison', {'expectation': results[0], 'current': result})
+                report.add_env('changes', counts)
+                report.begin_section('details')
+            for category in Change.CATEGORIES:
+                if not counts[category]:
+                    continue
+                for change in Comparison.join(comparison.read(results[0]), comparison.read(result)):
+                    if change.category != category:
+                        continue
+                    for report in reports:
+                        report.add_change(change)
+            for report in reports:
+                report.end()
+            timer.stop()
+
+            self._logger.info('%s against %s: %s in %s' % (result, results[0], ', '.join('%s %s' % (counts[category], category) for category in Change.CATEGORIES), timer.diff()))
+            for report in reports:
+                self._logger.info('Report is at %s' % report.path)
+
+    def _open_cache(self, args):
+        if args.cache:
+            # An update of the browser or the GPU driver may change results,
+            # while options like --user-data-dir differ by session and don't.
+            gpu = [self.gpu.vendor_id, self.gpu.product_id, self.gpu.product_name, self.gpu.driver_version, self.driver_stamp]
+            fingerprint = json.dumps([gpu, str(self.target_os), self.browser.get_fingerprint(), self.webgl_version])
+            self.result_cache = ResultCache('%s/cache.db' % self.log_dir, self.test_dir, fingerprint)
+
+    # GPU, OS and browser a worker tests on, for the coordinator
+    def _get_env(self):
+        return {
+            'gpu': [self.gpu.vendor_name, self.gpu.vendor_id, self.gpu.product_name, self.gpu.product_id, self.gpu.driver_version],
+            'driver_stamp': self.driver_stamp,
+            'target_os': {'name': self.target_os.name, 'version': self.target_os.version},
+            'browser': {
+                'name': self.browser.name,
+                'path': getattr(self.browser, 'path', ''),
+                'options': self.browser.options,
+                'version': self.browser.version,
+            },
+        }
+
+    def _set_env(self, env):
+        self.gpu = GPU(*env['gpu'])
+        self.driver_stamp = env.get('driver_stamp', '')
+        self.target_os = OS(env['target_os']['name'], env['target_os']['version'])
+        self.browser = Browser(env['browser']['name'], env['browser']['path'], [], self.target_os)
+        self.browser.options = env['browser']['options']
+        self.browser.version = env['browser']['version']
+
+    def _register_worker(self, worker_id):
+        shard = Shard(worker_id, None)
+        self.shards.append(shard)
+        return shard
+
+    # Take the result of a case run by a worker, whose crash is already handled there.
+    def _add_remote_case(self, shard, mode, index, case_index, total_count, case, cache_key):
+        self._add_case(shard, mode, case_index, case)
+        self._log_resume(shard, index, total_count, case.status, case.path)
+        if case.status == Status.PYTIMEOUT:
+            self.timing_history.add(case.path, self.timeout * 1000, timed_out=True)
+        elif case.time:
+            self.timing_history.add(case.path, case.time)
+        self._finish_case(shard, mode, case, cache_key)
+
+    # As a worker, run cases given by the coordinator with all shards, until
+    # it has no more. Results are kept by the coordinator rather than here.
+    def _run_worker(self, url, token):
+        self.worker = WorkerClient(url, token)
+        self.case_paths = self.worker.register(self._get_env(), self.version)
+        # cases are filtered by the coordinator
+        self.exp_suite = Suite()
+        self._logger.info('Registered to the coordinator at %s as worker %s' % (url, self.worker.worker_id))
+        try:
+            if len(self.shards) == 1:
+                self._run_worker_shard(self.shards[0])
             else:
-                status = Status.FAIL
+                threads = []
+                for shard in self.shards:
+                    thread = threading.Thread(target=self._run_shard_thread, args=(shard, self._run_worker_shard))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+                for shard in self.shards:
+                    if shard.aborted:
+                        Util.error('Shard %s aborted the work' % shard.id)
+        finally:
+            self.worker.close()
+            self.timing_history.save()
+
+    def _run_worker_shard(self, shard):
+        while not self.aborted:
+            batch = self.worker.get_batch()
+            if not batch:
+                break
+            if not shard.driver and not batch.get('fresh'):
+                self._start(shard)
+            for (item_id, mode, index, case_index) in batch['items']:
+                shard.item_id = item_id
+                if batch.get('fresh'):
+                    self._renew(shard, mode)
+                self._try_case(shard, mode, index, case_index, batch['total_count'])
+                self._check_recycle(shard, mode)
+            self._append_resume(shard)
+            shard.pending_case = None
+
+    # Devices of different models can't share expectations and a report, so each
+    # model is run in a process of its own, with all devices of the model.
+    def _fan_out(self, args, work_dir, groups):
+        if args.run_id:
+            Util.error('Run %s can not be resumed on devices of several models' % args.run_id)
+
+        argv = []
+        skip = False
+        for arg in sys.argv[1:]:
+            if skip:
+                skip = False
+            elif arg in ['--device-id', '--device-model']:
+                skip = True
+            elif not arg.startswith('--device-id=') and not arg.startswith('--device-model='):
+                argv.append(arg)
+
+        processes = []
+        for (model, devices) in groups:
+            cmd = [sys.executable, '%s/%s' % (work_dir, os.path.basename(sys.argv[0]))] + argv
+            cmd += ['--device-id', ','.join([device.id for device in devices]), '--device-model', model]
+            self._logger.info('Run on %s devices of %s' % (len(devices), model))
+            processes.append((model, subprocess.Popen(cmd)))
+
+        failed_models = []
+        for (model, process) in processes:
+            if process.wait():
+                failed_models.append(model)
+        if failed_models:
+            Util.error('Run failed on devices of %s' % ', '.join(failed_models))
+        self._logger.info('Run finished on devices of %s models' % len(groups))
+
+    # Crash in previous case may only be found in current case, so we just log
+    # the previous result so that we don't need to modify a record.
+    def _add_case(self, shard, mode, case_index, case):
+        if mode == 'firstrun':
+            shard.cases[case_index] = case
         else:
-            match = re.search(r'(.*) in (.+) ms', text)
-            if match:
-                time = float(match.group(2))
-                text_detail = match.group(1)
-                total = 0
-                match_detail = re.search(r'Passed: (\d+)/(\d+)', text_detail)
-                if match_detail:
-                    passed = int(match_detail.group(1))
-                    total_tmp = int(match_detail.group(2))
-                    if not total:
-                        total = total_tmp
-                    if total != total_tmp:
-                        Util.error('Total is not consistent')
-                else:
-                    passed = 0
-                match_detail = re.search(r'Skipped: (\d+)/(\d+)', text_detail)
-                if match_detail:
-                    skipped = int(match_detail.group(1))
-                    total_tmp = int(match_detail.group(2))
-                    if not total:
-                        total = total_tmp
-                    if total != total_tmp:
-                        Util.error('Total is not consistent')
-                else:
-                    skipped = 0
-                match_detail = re.search(r'Failed: (\d+)/(\d+)', text_detail)
-                if match_detail:
-                    failed = int(match_detail.group(1))
-                    total_tmp = int(match_detail.group(2))
-                    if not total:
-                        total = total_tmp
-                    if total != total_tmp:
-                        Util.error('Total is not consistent')
-                else:
-                    failed = 0
+            shard.retry_cases.append((case_index, case))
+        self.progress.finish_case(shard, case)
 
-                if passed + skipped + failed != total:
-                    Util.error('Total is not the sum of passed, skipped and failed')
+    def _append_resume(self, shard):
+        case = shard.pending_case
+        if not case:
+            return
+        if shard.pending_cache_key:
+            self.result_cache.put(shard.pending_cache_key, case)
+            shard.pending_cache_key = None
+        # a worker reports the case to the coordinator instead
+        if self.worker:
+            self.worker.put(shard.pending_item_id, case)
+            return
+        start_time = time.time()
+        self.resume_journal.add(case)
+        self.tracer.add(Tracer.RESUME_WRITE, start_time, shard, case.path)
+
+    def _crash(self, shard, error):
+        crash_case = shard.pending_case
+        shard.pending_cache_key = None
+        # a case already taken as a crash is not blamed again for a new browser
+        if crash_case and crash_case.status != Status.CRASH:
+            self.progress.crash(shard, crash_case.path, crash_case.is_pass())
+            crash_case.status = Status.CRASH
+            crash_case.total_count = 1
+            crash_case.pass_count = 0
+            self._logger.warning(self._get_shard_msg(shard, 'Case %s crashed' % crash_case.path))
+            self._save_logs(shard, crash_case, None, 'Crash found when the next case started: %s' % error)
+        self._start(shard)
+
+    # Images of a case that did not pass, taken while its page is still in the
+    # harness.
+    def _save_artifacts(self, shard, case, token):
+        if not self.artifact_store:
+            return
+        images = []
+        try:
+            if 'screenshot' in self.artifact_types:
+                images.append(shard.driver.get_screenshot_as_png())
+            if 'canvas' in self.artifact_types:
+                urls = shard.driver.execute_script('return window.conformanceHost.readCanvases(arguments[0], arguments[1]);', self.ARTIFACT_CANVAS_COUNT, token)
+                for url in urls or []:
+                    images.append(base64.b64decode(url.split(',', 1)[1]))
+        except WebDriverException:
+            pass
+        self.artifact_store.set(case.path, [self.artifact_store.put(image) for image in images])
 
-                if total == passed + skipped:
-                    status = Status.PASS
+    # Console messages of a case that did not pass are pulled from the harness
+    # page while it's still there, along with the error found by this script.
+    def _save_logs(self, shard, case, token, error=None):
+        if not self.case_log_store:
+            return
+        logs = []
+        if token:
+            try:
+                logs = shard.driver.execute_script('return window.conformanceHost.getLogs(arguments[0]);', token) or []
+            except WebDriverException:
+                pass
+        if error:
+            logs.append([int(time.time() * 1000), 'runner', 'error', error])
+        self.case_log_store.add(case, logs)
+
+    # The case is pending until the next one shows the browser didn't crash,
+    # and is only then appended to resume and put into the result cache.
+    def _finish_case(self, shard, mode, case, cache_key=None):
+        if mode == 'firstrun' or self.worker:
+            self._append_resume(shard)
+        shard.pending_case = case
+        shard.pending_cache_key = cache_key
+        shard.pending_item_id = shard.item_id
+
+    def _gen_report(self):
+        # summary
+        summary = []
+        path_index = {}
+        for case in self.cur_suite.suite:
+            path = case.path.split('/')[0]
+            if path not in path_index:
+                path_index[path] = len(path_index)
+                case = Case(path, total_count=case.total_count, pass_count=case.pass_count)
+                summary.append(case)
+            else:
+                index = path_index[path]
+                summary[index].total_count += case.total_count
+                summary[index].pass_count += case.pass_count
+        total_count = 0
+        pass_count = 0
+        for case in summary:
+            total_count += case.total_count
+            pass_count += case.pass_count
+        case = Case('all', total_count=total_count, pass_count=pass_count)
+        summary.append(case)
+
+        # top_time
+        top_time = heapq.nlargest(self.TOP_TIME_COUNT, [case for case in self.cur_suite.suite if case.path], key=lambda x: x.time)
+
+        # stream all sections to every report in one pass
+        reports = []
+        for report_format in self.report_formats:
+            report_class = self.REPORT_FORMATS[report_format]
+            reports.append(report_class('%s/%s.%s' % (self.result_dir, self.timestamp, report_class.EXTENSION), self.artifact_store))
+
+        for report in reports:
+            report.begin()
+            report.begin_section('environment')
+        for env in ['gpu', 'host_os', 'target_os', 'browser']:
+            if env == 'target_os' and self.host_os == self.target_os:
+                continue
+            env_dict = json.loads(str(getattr(self, env)))
+            for report in reports:
+                report.add_env(env, env_dict)
+        # cases are spread across devices of the same model
+        if len(self.mobile_devices) > 1:
+            for shard in self.shards:
+                env_dict = {
+                    'id': shard.mobile_device.id,
+                    'model': shard.mobile_device.get_model(),
+                    'cases': shard.case_count,
+                    'pass': shard.pass_count,
+                }
+                for report in reports:
+                    report.add_env('device %s' % shard.id, env_dict)
+
+        if self.recycles:
+            memory_recycles = [recycle for recycle in self.recycles if recycle[2] == 'memory']
+            env_dict = {
+                'count': len(self.recycles),
+                'by cases': len(self.recycles) - len(memory_recycles),
+                'by memory': len(memory_recycles),
+                'first': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.recycles[0][0])),
+                'last': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.recycles[-1][0])),
+            }
+            for report in reports:
+                report.add_env('recycles', env_dict)
+
+        for report in reports:
+            report.begin_section('summary')
+        for case in summary:
+            for report in reports:
+                report.add_summary(case)
+
+        # one change for each case, by category and then in the order of the suite
+        for report in reports:
+            report.begin_section('details')
+        for category in Change.CATEGORIES:
+            for change in self._iter_changes():
+                if change.category != category:
+                    continue
+                for report in reports:
+                    report.add_change(change)
+
+        for report in reports:
+            report.begin_section('retry')
+        for index in self.cur_suite.retry_index:
+            case = self.cur_suite.get_case(index)
+            for report in reports:
+                report.add_retry(case)
+
+        for report in reports:
+            report.begin_section('top_time')
+        for case in top_time:
+            for report in reports:
+                report.add_top_time(case)
+
+        for report in reports:
+            report.begin_section('phases')
+        for phase in Tracer.PHASES:
+            (count, seconds) = self.tracer.totals[phase]
+            for report in reports:
+                report.add_phase(phase, count, seconds)
+
+        for report in reports:
+            report.end()
+            self._logger.info('Report is at %s' % report.path)
+
+    # Yield a change for each case of the current suite and then for each case
+    # expected to fail that is no longer in it. Changes are made again in each
+    # pass rather than kept, as there may be hundreds of thousands of them.
+    def _iter_changes(self):
+        for cur_case in self.cur_suite.suite:
+            path = cur_case.path
+            if path not in self.exp_suite.issue_path:
+                exp_case = Case(path, Status.PASS, cur_case.total_count, cur_case.total_count)
+                if path in self.cur_suite.issue_path:
+                    category = Change.REGRESS
                 else:
-                    status = Status.FAIL
+                    category = Change.PASS
             else:
-                total = 1
-                status = Status.JSTIMEOUT
-                passed = 0
-                skipped = 0
-                time = 0
+                exp_case = self.exp_suite.get_case(self.exp_suite.path_index[path])
+                if path not in self.cur_suite.issue_path:
+                    category = Change.IMPROVE_PASS
+                else:
+                    category = Change.get_category(exp_case, cur_case)
+            yield Change(exp_case, cur_case, category)
+        for exp_case in self.exp_suite.suite:
+            if exp_case.path in self.exp_suite.issue_path and exp_case.path not in self.cur_suite.path_index:
+                cur_case = Case(exp_case.path, Status.NOTEXIST)
+                yield Change(exp_case, cur_case, Change.get_category(exp_case, cur_case))
+
+    def _get_result(self, result):
+        if result['timedOut']:
+            return (Status.JSTIMEOUT, 1, 0, 0)
+
+        counts = result['counts']
+        total = sum(counts.values())
+        # passed includes both results of passed and skipped
+        passed = counts[Subtest.PASS] + counts[Subtest.SKIP]
+        if total == passed:
+            status = Status.PASS
+        else:
+            status = Status.FAIL
+        return (status, total, passed, float(result['time']))
 
-        return (status, total, passed + skipped, time)
+    def _get_shard_msg(self, shard, msg):
+        if self.coordinator:
+            return '[worker %s] %s' % (shard.id, msg)
+        elif len(self.mobile_devices) > 1:
+            return '[device %s] %s' % (shard.mobile_device.id, msg)
+        elif len(self.shards) + len(self.retry_shards) > 1:
+            return '[shard %s] %s' % (shard.id, msg)
+        return msg
 
-    def _log_resume(self, index, total_count, msg, case_path):
-        self._logger.info('(%s/%s) %s %s' % (index + 1, total_count, msg, case_path))
+    def _log_resume(self, shard, index, total_count, msg, case_path):
+        self._logger.info(self._get_shard_msg(shard, '(%s/%s) %s %s' % (index + 1, total_count, msg, case_path)))
 
     def _run(self, mode):
         if mode == 'firstrun':
-            total_count = len(self.case_elements)
+            total_count = len(self.case_paths)
         elif mode == 'retry':
             total_count = len(self.cur_suite.retry_index)
         else:
@@ -1505,135 +4318,542 @@ class Conformance(object):
         if total_count < 1 and mode == 'firstrun':
             Util.error('No case will be tested')
         elif total_count < 1 and mode == 'retry':
-            f = open(self.resume_file, 'a')
-            f.write(self.TEST_DONE + '\n')
-            f.close()
+            self.resume_journal.finish_run()
             self._logger.info('No need the %s' % mode)
             return
         else:
             self._logger.info('Begin the %s...' % mode)
 
+        # case index -> Case
+        cases = {}
         if mode == 'firstrun':
-            # resume_count
-            if os.path.exists(self.resume_file):
-                resume_lines = Util.read_file(self.resume_file)
-                resume_count = len(resume_lines)
-                if resume_count > 0 and resume_lines[-1].rstrip('\n') == self.TEST_DONE:
-                    resume_count = 0
-            else:
-                resume_count = 0
-
-            # resume file
-            if resume_count == 0:
-                Util.ensure_nofile(self.resume_file)
-                Util.ensure_file(self.resume_file)
-            f = open(self.resume_file, 'a')
-
-            # resume
-            if resume_count > 0:
-                if resume_count > len(self.case_elements) or resume_lines[-1].split(',')[0] != self.case_elements[resume_count - 1].find_element(By.XPATH, './div/a').text:
-                    Util.error('The suite currently tested is different from the resumed one')
-
-                for resume_line in resume_lines:
-                    fields = resume_line.split(',')
-                    case = Case(fields[0], fields[1], int(fields[2]), int(fields[3]), float(fields[4]))
-                    self.cur_suite.add_case(case)
-                self._logger.info('Resume %s cases' % resume_count)
-
-            index = resume_count
+            # resume, the suite is identified by the hash of its case paths
+            # and the device model if several models are run at the same time
+            suite = hashlib.sha1('\n'.join(self.case_paths).encode('utf-8')).hexdigest()
+            suite += self.device_tag
+            resume_cases = self.resume_journal.open_run(suite, self.run_id, self.timestamp)
+            if resume_cases:
+                path_index = dict((path, index) for (index, path) in enumerate(self.case_paths))
+                for case in resume_cases:
+                    cases[path_index[case.path]] = case
+                self._logger.info('Resume %s cases of run %s' % (len(resume_cases), self.resume_journal.run_id))
+
+            shards = self.shards
+            # (index in this mode, case index)
+            run_indexes = [(index, index) for index in range(total_count) if index not in cases]
         else:
-            index = 0
-        while index < total_count:
-            if mode == 'firstrun':
-                case_index = index
-                case_element = self.case_elements[case_index]
+            # runs of a case are next to each other, so that shards run them at the same time
+            shards = self.shards + self.retry_shards
+            run_indexes = []
+            for run_index in enumerate(self.cur_suite.retry_index):
+                run_indexes += [run_index] * self.retry_count
+        if len(shards) > 1 or self.coordinator:
+            run_indexes = self._schedule(run_indexes)
+
+        case_queue = queue.Queue()
+        for run_index in run_indexes:
+            case_queue.put(run_index)
+        self.progress.begin(mode, [self.case_paths[case_index] for (index, case_index) in run_indexes], len(cases), len(shards))
+
+        try:
+            if self.coordinator:
+                self.coordinator.run(mode, run_indexes, total_count, fresh=mode == 'retry' and self.retry_count > 1)
+                for shard in shards:
+                    if mode == 'firstrun':
+                        self._append_resume(shard)
+                    shard.pending_case = None
+            elif len(shards) == 1:
+                self._run_shard(shards[0], mode, case_queue, total_count)
             else:
-                case_index = self.cur_suite.retry_index[index]
-                case_element = self.case_elements[case_index]
-                case = self.cur_suite.get_case(case_index)
-            case_path = case_element.find_element(By.XPATH, './div/a').text
-
-            # filter
-            if mode == 'firstrun' and case_path in self.exp_suite.filter_path:
-                case = Case(case_path, Status.FILTER)
-                self.cur_suite.add_case(case)
-                self._log_resume(index, total_count, 'Filter', case_path)
-                if mode == 'firstrun':
-                    self._append_resume(f, index)
-                index += 1
+                threads = []
+                for shard in shards:
+                    thread = threading.Thread(target=self._run_shard_thread, args=(shard, self._run_shard, mode, case_queue, total_count))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+                for shard in shards:
+                    if shard.aborted:
+                        Util.error('Shard %s aborted the %s' % (shard.id, mode))
+        finally:
+            self.resume_journal.flush()
+            self.timing_history.save()
+
+        # merge results of all shards in the order of cases
+        if mode == 'firstrun':
+            for shard in shards:
+                cases.update(shard.cases)
+                shard.case_count += len(shard.cases)
+                shard.pass_count += len([case for case in shard.cases.values() if case.is_pass()])
+                shard.cases = {}
+            for index in sorted(cases):
+                self.cur_suite.add_case(cases[index])
+                if cases[index].is_pass():
+                    self.flake_history.add_clean(cases[index].path)
+        else:
+            runs = {}
+            for shard in shards:
+                for (case_index, case) in shard.retry_cases:
+                    runs.setdefault(case_index, []).append(case)
+                shard.retry_cases = []
+            for case_index in sorted(runs):
+                self._merge_retry(case_index, runs[case_index])
+            self.flake_history.save()
+            self.resume_journal.finish_run()
+
+    # A case passing in any run of the retry is flaky rather than failing, and
+    # takes the result of that run. Otherwise, it takes the result of the last run.
+    def _merge_retry(self, case_index, runs):
+        case = self.cur_suite.get_case(case_index)
+        pass_runs = [run for run in runs if run.is_pass()]
+        self.flake_history.add(case.path, len(runs), len(pass_runs), case.total_count, case.pass_count)
+        if len(runs) > 1:
+            self._logger.info('Case %s passed %s of %s runs in retry' % (case.path, len(pass_runs), len(runs)))
+
+        if pass_runs:
+            run = pass_runs[0]
+        else:
+            run = runs[-1]
+        case.status = run.status
+        case.total_count = run.total_count
+        case.pass_count = run.pass_count
+        case.time = run.time
+        if case.is_pass():
+            self.cur_suite.remove_issue(case_index)
+
+    def _run_shard(self, shard, mode, case_queue, total_count):
+        # each of several runs of a case in retry is done in a fresh browser
+        fresh = mode == 'retry' and self.retry_count > 1
+        if not shard.driver and not fresh:
+            self._start(shard)
+
+        shard.pending_case = None
+        if self.page_concurrency > 1 and not fresh:
+            self._run_pages(shard, mode, case_queue, total_count)
+        while not self.aborted:
+            try:
+                (index, case_index) = case_queue.get_nowait()
+            except queue.Empty:
+                break
+            if fresh:
+                self._renew(shard, mode)
+            self._try_case(shard, mode, index, case_index, total_count)
+            self._check_recycle(shard, mode)
+
+        if mode == 'firstrun':
+            self._append_resume(shard)
+        shard.pending_case = None
+
+    # With --page-concurrency, up to that number of pages run at the same time
+    # in the harness page. Timing-sensitive cases are run alone. So are the
+    # pages in flight when the browser has to be started again, as it's not
+    # known which of them crashed or hung it.
+    def _run_pages(self, shard, mode, case_queue, total_count):
+        # token -> (index, case index, start time, timeout, cache key) of pages in flight
+        pages = {}
+        # (index, case index) to run alone
+        serial_indexes = []
+        while not self.aborted:
+            if shard.recycle and not pages:
+                self._recycle(shard, mode)
+            if serial_indexes and not pages:
+                (index, case_index) = serial_indexes.pop(0)
+                self._try_case(shard, mode, index, case_index, total_count)
+                self._check_recycle(shard, mode)
                 continue
 
-            # run test
-            self._log_resume(index, total_count, 'Run', case_path)
+            # no more pages are started while the browser is due to be recycled
+            while len(pages) < self.page_concurrency and not serial_indexes and not shard.recycle:
+                try:
+                    (index, case_index) = case_queue.get_nowait()
+                except queue.Empty:
+                    break
+                case_path = self.case_paths[case_index]
+                running_paths = [self.case_paths[page[1]] for page in pages.values()]
+                # pages are told apart by path in the harness
+                if self.serial_pattern.search(case_path) or case_path in self.flaky_paths or case_path in running_paths:
+                    serial_indexes.append((index, case_index))
+                    break
+                (done, cache_key) = self._skip_case(shard, mode, index, case_index, total_count)
+                if done:
+                    continue
+                try:
+                    (token, start_time) = self._start_case(shard, index, case_path, total_count)
+                except WebDriverException as e:
+                    self._logger.warning(self._get_shard_msg(shard, 'Browser is gone: %s' % str(e).strip()))
+                    serial_indexes.append((index, case_index))
+                    self._restart_pages(shard, mode, pages, serial_indexes)
+                    break
+                pages[token] = (index, case_index, start_time, self._get_timeout(case_path), cache_key)
+
+            if not pages:
+                if serial_indexes or shard.recycle:
+                    continue
+                break
+            self._wait_pages(shard, mode, pages, serial_indexes)
+            self._check_recycle_due(shard)
+
+    # Wait for any of the pages in flight, and handle the pages finished
+    def _wait_pages(self, shard, mode, pages, serial_indexes):
+        now = time.time()
+        deadline = min(page[2] + page[3] for page in pages.values())
+        if deadline <= now:
+            for (token, (index, case_index, start_time, timeout, cache_key)) in list(pages.items()):
+                if start_time + timeout <= now:
+                    del pages[token]
+                    self.collector.discard(token)
+                    # other pages are run again after the browser is started again
+                    for page in pages.values():
+                        serial_indexes.append(page[:2])
+                    self._discard_pages(shard, mode, pages)
+                    self._timeout_case(shard, mode, case_index, token, start_time, timeout)
+                    return
+
+        token = self.collector.wait_any(list(pages), min(deadline - now, self.POLL_INTERVAL))
+        # pages are checked now and then in case the push is blocked
+        tokens = [token] if token else list(pages)
+        for token in tokens:
+            (index, case_index, start_time, timeout, cache_key) = pages[token]
             try:
-                button = case_element.find_element(By.XPATH, './div/input[@type="button"]')
-                button.click()
-            except NoSuchElementException:
-                self._crash(mode, index)
+                result = shard.driver.execute_script('return window.conformanceHost.getResult(arguments[0]);', token)
+            except WebDriverException as e:
+                self._logger.warning(self._get_shard_msg(shard, 'Browser is gone: %s' % str(e).strip()))
+                self._restart_pages(shard, mode, pages, serial_indexes)
+                return
+            if not result:
                 continue
+            del pages[token]
+            self.collector.discard(token)
+            self.tracer.add(Tracer.WAIT_RESULT, start_time, shard, self.case_paths[case_index])
+            if not self._finish_result(shard, mode, case_index, token, start_time, result, cache_key):
+                self._logger.warning(self._get_shard_msg(shard, 'Unable to fetch WebGL rendering context in %s' % self.case_paths[case_index]))
+                serial_indexes.append((index, case_index))
+                self._restart_pages(shard, mode, pages, serial_indexes)
+                return
+
+    # Start the browser again, and run the pages in flight alone later
+    def _restart_pages(self, shard, mode, pages, serial_indexes):
+        for page in pages.values():
+            serial_indexes.append(page[:2])
+        self._discard_pages(shard, mode, pages)
+        self._start(shard)
+
+    def _discard_pages(self, shard, mode, pages):
+        for token in pages:
+            self.collector.discard(token)
+        pages.clear()
+        # cases finished before are not to blame, as the pages in flight are run again
+        if mode == 'firstrun':
+            self._append_resume(shard)
+        shard.pending_case = None
 
-            # handle result
+    def _run_shard_thread(self, shard, run, *args):
+        try:
+            run(shard, *args)
+        except SystemExit:
+            # Util.error() only exits this thread, so stop other shards as well.
+            shard.aborted = True
+            self.aborted = True
+        except Exception:
+            self._logger.exception(self._get_shard_msg(shard, 'Unexpected error'))
+            shard.aborted = True
+            self.aborted = True
+
+    # Long sessions slow down as the browser grows, until a case can't even get a
+    # WebGL context. So the browser is recycled between cases once it has run
+    # --recycle-cases cases, or uses more than --recycle-memory MB.
+    def _check_recycle(self, shard, mode):
+        self._check_recycle_due(shard)
+        if shard.recycle:
+            self._recycle(shard, mode)
+
+    # Set shard.recycle if the browser is due to be recycled
+    def _check_recycle_due(self, shard):
+        if shard.recycle:
+            return
+        if self.recycle_cases and shard.session_case_count >= self.recycle_cases:
+            shard.recycle = ('cases', None)
+        elif self.recycle_memory and shard.session_case_count - shard.sample_case_count >= self.memory_interval:
+            shard.sample_case_count = shard.session_case_count
+            memory = self._get_memory(shard)
+            if memory is not None and memory > self.recycle_memory:
+                shard.recycle = ('memory', memory)
+
+    def _recycle(self, shard, mode):
+        (reason, memory) = shard.recycle
+        if memory is None:
+            msg = 'Recycle the browser after %s cases' % shard.session_case_count
+        else:
+            msg = 'Recycle the browser using %.0f MB after %s cases' % (memory, shard.session_case_count)
+        self._logger.info(self._get_shard_msg(shard, msg))
+        with self.lock:
+            self.recycles.append((time.time(), shard.id, reason, shard.session_case_count, memory))
+        self.progress.recycle(shard, reason, shard.session_case_count, memory)
+        self._renew(shard, mode)
+
+    # The browser is quit before a new one is started, as it would otherwise
+    # be left running with the lock of the user data dir.
+    def _renew(self, shard, mode):
+        # the previous case is done as the browser is still alive
+        if mode == 'firstrun' or self.worker:
+            self._append_resume(shard)
+        shard.pending_case = None
+        if shard.webdriver:
             try:
-                WebDriverWait(self.driver, self.timeout).until(lambda driver: re.search('(passed|skipped|failed|timeout)', case_element.find_element(By.XPATH, './div').text, re.I))
-            except TimeoutException:
-                if mode == 'firstrun':
-                    case = Case(case_path, Status.PYTIMEOUT)
-                    self.cur_suite.add_case(case)
-                self._logger.warning('Case %s timeout in python script' % case_path)
-                self._start()
-                index += 1
-            else:
-                (case_status, case_total_count, case_pass_count, case_time) = self._get_result(case_element.find_element(By.XPATH, './div').text)
-                if mode == 'firstrun':
-                    case = Case(case_path, case_status, case_total_count, case_pass_count, case_time)
-                    self.cur_suite.add_case(case)
-                else:
-                    case.status = case_status
-                    case.total_count = case_total_count
-                    case.pass_count = case_pass_count
-                    case.time = case_time
-                self._logger.info(case.status)
-
-                if case.is_pass():
-                    if mode == 'retry':
-                        self.cur_suite.remove_issue(case_index)
-                elif case_element.find_element(By.XPATH, './ul').find_elements(By.TAG_NAME, 'li') and re.search('Unable to fetch WebGL rendering context for Canvas', case_element.find_element(By.XPATH, './ul/li').text):
-                    self._crash(mode, index)
-                    continue
+                shard.webdriver.quit()
+            except WebDriverException:
+                pass
+        self._start(shard)
 
-                if mode == 'firstrun':
-                    self._append_resume(f, index)
-                index += 1
+    # Memory of the browser in MB, or None if it's unknown
+    def _get_memory(self, shard):
+        memory = shard.webdriver.get_process_memory()
+        if memory is not None:
+            return memory
+        try:
+            heap_size = shard.driver.execute_script('return window.performance && performance.memory ? performance.memory.usedJSHeapSize : null;')
+        except WebDriverException:
+            return None
+        if heap_size is None:
+            return None
+        return heap_size / 1024.0 / 1024.0
+
+    # Order (index in this mode, case index) by expected duration, the longest
+    # first. As shards pull cases from a shared queue, this balances them like
+    # LPT scheduling. Cases never run before are expected to take the average.
+    def _schedule(self, run_indexes):
+        durations = {}
+        for (index, case_index) in run_indexes:
+            durations[case_index] = self.timing_history.estimate(self.case_paths[case_index], None)
+        known = [duration for duration in durations.values() if duration is not None]
+        if not known:
+            return run_indexes
+        average = sum(known) / len(known)
+        for case_index in durations:
+            if durations[case_index] is None:
+                durations[case_index] = average
+        return sorted(run_indexes, key=lambda x: durations[x[1]], reverse=True)
+
+    # Return (True, None) if the case is done without running it, as it's
+    # filtered or its result is cached, or else (False, cache key).
+    def _skip_case(self, shard, mode, index, case_index, total_count):
+        case_path = self.case_paths[case_index]
+
+        # filter
+        if mode == 'firstrun' and case_path in self.exp_suite.filter_path:
+            case = Case(case_path, Status.FILTER)
+            self._add_case(shard, mode, case_index, case)
+            self._log_resume(shard, index, total_count, 'Filter', case_path)
+            self._finish_case(shard, mode, case)
+            return (True, None)
+
+        # cache
+        cache_key = None
+        if mode == 'firstrun' and self.result_cache:
+            start_time = time.time()
+            cache_key = self.result_cache.get_key(case_path)
+            case = cache_key and self.result_cache.get(cache_key)
+            self.tracer.add(Tracer.LOOKUP, start_time, shard, case_path)
+            if case:
+                self._add_case(shard, mode, case_index, case)
+                self._log_resume(shard, index, total_count, 'Cached', case_path)
+                self._finish_case(shard, mode, case)
+                return (True, None)
+
+        return (False, cache_key)
+
+    # A case is run again in a new browser when the browser was found to have
+    # crashed, but a case that no browser can run, like a WebGL 2 case on a
+    # machine without WebGL 2, is taken as a crash rather than run forever.
+    def _try_case(self, shard, mode, index, case_index, total_count):
+        for i in range(self.MAX_CASE_TRIES):
+            if self._run_case(shard, mode, index, case_index, total_count):
+                return
+        case_path = self.case_paths[case_index]
+        case = Case(case_path, Status.CRASH, 1, 0)
+        self._add_case(shard, mode, case_index, case)
+        self._logger.warning(self._get_shard_msg(shard, 'Case %s could not be run in %s new browsers' % (case_path, self.MAX_CASE_TRIES)))
+        self._save_logs(shard, case, None, 'Could not be run in %s new browsers' % self.MAX_CASE_TRIES)
+        self._finish_case(shard, mode, case)
+
+    # Return False if the case needs to be run again.
+
+    def _run_case(self, shard, mode, index, case_index, total_count):
+        case_path = self.case_paths[case_index]
+        (done, cache_key) = self._skip_case(shard, mode, index, case_index, total_count)
+        if done:
+            return True
 
-        if mode == 'firstrun':
-            self._append_resume(f, index)
-        if mode == 'retry':
-            f = open(self.resume_file, 'a')
-            f.write(self.TEST_DONE + '\n')
-        f.close()
+        # run test
+        try:
+            (token, start_time) = self._start_case(shard, index, case_path, total_count)
+        except WebDriverException as e:
+            self._crash(shard, str(e).strip())
+            return False
 
-    def _start(self, is_firstrun=False):
-        self.webdriver = Webdriver(browser=self.browser, path=self.webdriver_path, host_os=self.host_os, target_os=self.target_os, mobile_device=self.mobile_device, tools=self.open_tools)
-        self.driver = self.webdriver.driver
+        # handle result
+        timeout = self._get_timeout(case_path)
+        try:
+            result = self._wait_result(shard, token, timeout, case_path)
+        except TimeoutException:
+            self._timeout_case(shard, mode, case_index, token, start_time, timeout)
+        except WebDriverException as e:
+            # The harness page is gone while the case is running
+            case = Case(case_path, Status.CRASH, 1, 0)
+            self._add_case(shard, mode, case_index, case)
+            self.timing_history.add(case_path, (time.time() - start_time) * 1000)
+            self._logger.warning(self._get_shard_msg(shard, 'Case %s crashed' % case_path))
+            self._save_logs(shard, case, None, str(e).strip())
+            self._start(shard)
+            self._finish_case(shard, mode, case)
+        else:
+            if not self._finish_result(shard, mode, case_index, token, start_time, result, cache_key):
+                self._crash(shard, 'Unable to fetch WebGL rendering context for Canvas')
+                return False
 
-        if is_firstrun:
-            self.browser.update(self.driver)
-            self.gpus = GPUs(self.target_os, self.mobile_device, self.driver)
-            self.gpu = self.gpus.get_active(self.driver)
-            self.exp_suite = Suite()
-            for exp in Expectations().expectations:
-                if exp.is_valid(self.gpu, self.target_os, self.browser) and (self.args.suite == 'all' or re.match(self.args.suite, exp.path)):
-                    self.exp_suite.add_case(Case(exp.path, exp.status, exp.total_count, exp.pass_count))
-            self.cur_suite = Suite(self.exp_suite)
+        return True
 
-        self.driver.get(self.url)
+    # Load a case into the harness page, and return its token and start time
+    def _start_case(self, shard, index, case_path, total_count):
+        self._log_resume(shard, index, total_count, 'Run', case_path)
+        self.progress.start_case(shard, case_path)
+        shard.run_count += 1
+        shard.session_case_count += 1
+        token = '%s-%s' % (shard.id, shard.run_count)
+        self.collector.expect(token)
+        start_time = time.time()
         try:
-            WebDriverWait(self.driver, 60).until(lambda driver: self.driver.find_element(By.ID, 'page0'))
-        except TimeoutException:
-            Util.error('Could not open %s correctly' % self.url)
+            shard.driver.execute_script('window.conformanceHost.run(arguments[0], arguments[1]);', '%s?webglVersion=%s' % (case_path, self.webgl_version), token)
+        except WebDriverException:
+            self.collector.discard(token)
+            raise
+        self.tracer.add(Tracer.START_CASE, start_time, shard, case_path)
+        return (token, start_time)
+
+    # The browser is started again, as the page may hang
+    def _timeout_case(self, shard, mode, case_index, token, start_time, timeout):
+        case_path = self.case_paths[case_index]
+        self.timing_history.add(case_path, (time.time() - start_time) * 1000, timed_out=True)
+        case = Case(case_path, Status.PYTIMEOUT)
+        self._add_case(shard, mode, case_index, case)
+        self._logger.warning(self._get_shard_msg(shard, 'Case %s timeout in python script after %.1f seconds' % (case_path, timeout)))
+        self._save_logs(shard, case, token, 'Timeout in python script after %.1f seconds' % timeout)
+        self._save_artifacts(shard, case, token)
+        self._start(shard)
+        self._finish_case(shard, mode, case)
+
+    # Add the case of a result pulled from the harness page. Return False if
+    # the browser could not create a WebGL context, which needs a new browser.
+    def _finish_result(self, shard, mode, case_index, token, start_time, result, cache_key):
+        case_path = self.case_paths[case_index]
+        self.timing_history.add(case_path, (time.time() - start_time) * 1000)
+        parse_time = time.time()
+        self.subtest_store.add(case_path, result)
+        case = Case(case_path, *self._get_result(result))
+        self.tracer.add(Tracer.PARSE_RESULT, parse_time, shard, case_path)
+        if self.page_concurrency > 1:
+            self._logger.info(self._get_shard_msg(shard, '%s %s' % (case.status, case_path)))
+        else:
+            self._logger.info(self._get_shard_msg(shard, case.status))
+        if not case.is_pass() and Subtest.FAIL in result['statuses'] and re.search('Unable to fetch WebGL rendering context for Canvas', result['messages'][result['statuses'].index(Subtest.FAIL)]):
+            return False
+
+        if not case.is_pass():
+            self._save_logs(shard, case, token)
+            self._save_artifacts(shard, case, token)
+        self._add_case(shard, mode, case_index, case)
+        self._finish_case(shard, mode, case, cache_key)
+        return True
+
+    # With --timeout-factor, the timeout of a case is derived from the 99th
+    # percentile of its past durations, so a quick case that hangs is found
+    # early while a slow one is given enough time. Others use --timeout.
+    def _get_timeout(self, case_path):
+        if not self.timeout_factor:
+            return self.timeout
+        duration = self.timing_history.get_percentile(case_path, 99)
+        if duration is None:
+            return self.timeout
+        return min(max(duration / 1000.0 * self.timeout_factor, self.min_timeout), self.max_timeout)
+
+    # Results are pushed to the collector as soon as a case finishes, while the
+    # harness page is still checked now and then in case the push is blocked or
+    # the page is gone.
+    def _wait_result(self, shard, token, timeout, case_path):
+        start_time = time.time()
+        deadline = start_time + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutException()
+                # either the collector is notified or it's time to check the page anyway
+                self.collector.wait(token, min(remaining, self.POLL_INTERVAL))
+                result = shard.driver.execute_script('return window.conformanceHost.getResult(arguments[0]);', token)
+                if result:
+                    return result
+        finally:
+            self.collector.discard(token)
+            self.tracer.add(Tracer.WAIT_RESULT, start_time, shard, case_path)
+
+    # Launch a browser session ready to run cases, for the standby pool.
+    def _launch(self, browser):
+        webdriver = self.webdriver_class(browser=browser, path=self.webdriver_path, host_os=self.host_os, target_os=self.target_os, mobile_device=self.mobile_device, tools=self.open_tools)
+        webdriver.driver.get(self.url)
+        webdriver.driver.execute_script(self.HOST_SCRIPT, self.PAGE_TIMEOUT, self.PAGE_SUBTEST_COUNT, self.collector.url, self.case_log_count)
+        return webdriver
+
+    def _start(self, shard, is_firstrun=False):
+        start_time = time.time()
+        shard.session_case_count = 0
+        shard.sample_case_count = 0
+        shard.recycle = None
+        if self.standby_pool:
+            session = self.standby_pool.get()
+            if session:
+                self.progress.restart(shard, True)
+                # the browser of the shard is launched again as a standby one
+                self.standby_pool.put(shard.browser, shard.webdriver)
+                (shard.browser, shard.webdriver) = session
+                shard.driver = shard.webdriver.driver
+                self._logger.info(self._get_shard_msg(shard, 'Switch to a standby browser'))
+                self.tracer.add(Tracer.SESSION_START, start_time, shard)
+                return
+
+        if not is_firstrun:
+            self.progress.restart(shard, False)
+        launch = lambda: self.webdriver_class(browser=shard.browser, path=self.webdriver_path, host_os=self.host_os, target_os=self.target_os, mobile_device=shard.mobile_device, tools=self.open_tools)
+        if is_firstrun and not self.fake_cases and not self.target_os.is_cros():
+            # GPUs are probed (lshw, wmic or adb) while the first browser starts,
+            # except on Chrome OS where they are read from chrome://gpu
+            probe = lambda: GPUs(self.target_os, self.mobile_device, None, self.fingerprint_cache)
+            (shard.webdriver, self.gpus) = Util.map_parallel(lambda func: func(), [launch, probe])
+        else:
+            shard.webdriver = launch()
+        shard.driver = shard.webdriver.driver
+        self.tracer.add(Tracer.SESSION_START, start_time, shard)
 
         if is_firstrun:
-            option_element = Select(self.driver.find_element(By.ID, 'testVersion')).first_selected_option
+            self.driver = shard.driver
+            self.browser.update(self.driver)
+            if self.fake_cases:
+                self.gpu = GPU('', '', 'Fake GPU', '', '')
+            else:
+                if self.target_os.is_cros():
+                    self.gpus = GPUs(self.target_os, self.mobile_device, self.driver, self.fingerprint_cache)
+                self.gpu = self.gpus.get_active(self.driver, self.browser.get_fingerprint())
+            self._load_expectations()
+
+        start_time = time.time()
+        shard.driver.get(self.url)
+        if is_firstrun and not self.fake_cases:
+            try:
+                WebDriverWait(shard.driver, 60).until(lambda driver: driver.find_element(By.ID, 'page0'))
+            except TimeoutException:
+                Util.error('Could not open %s correctly' % self.url)
+
+            option_element = Select(shard.driver.find_element(By.ID, 'testVersion')).first_selected_option
             real_version = option_element.text
             type = self.VERSION_TYPE[self.version]
             if type == 'beta':
@@ -1641,33 +4861,142 @@ class Conformance(object):
             if self.version != real_version:
                 Util.error('The designated version does not match the real version')
 
-        self._get_case_elements()
+        shard.driver.execute_script(self.HOST_SCRIPT, self.PAGE_TIMEOUT, self.PAGE_SUBTEST_COUNT, self.collector.url, self.case_log_count)
+        self.tracer.add(Tracer.HARNESS_LOAD, start_time, shard)
+
+    # Build the expected suite from expectations valid for the GPU, OS and browser
+    def _load_expectations(self):
+        self.exp_suite = Suite()
+        expectations = self.expectations.compile(self.gpu, self.target_os, self.browser)
+        for case_path in self.case_paths:
+            exp = Expectations.lookup(expectations, case_path)
+            if exp:
+                self.exp_suite.add_case(Case(case_path, exp.status, exp.total_count, exp.pass_count))
+        # expected cases no longer in the suite are reported as removed
+        case_paths = set(self.case_paths)
+        for (path, exp) in expectations.items():
+            if not path.endswith('/') and path not in case_paths and (self.args.suite == 'all' or re.match(self.args.suite, path)):
+                self.exp_suite.add_case(Case(path, exp.status, exp.total_count, exp.pass_count))
+        # flaky cases are expected to fail as last time, so that they are not retried
+        if self.quarantine:
+            quarantine_count = 0
+            for (path, total_count, pass_count) in self.flake_history.get_quarantined(self.quarantine, case_paths):
+                if path not in self.exp_suite.path_index:
+                    self.exp_suite.add_case(Case(path, Status.FAIL, total_count, pass_count))
+                    quarantine_count += 1
+            self._logger.info('Quarantine %s flaky cases' % quarantine_count)
+        self.cur_suite = Suite(self.exp_suite)
 
 
 class Expectation(object):
-    def __init__(self, version, path, status, total_count=0, pass_count=0, gpu=None, os=None, browser=None):
+    def __init__(self, version, path, status, total_count=0, pass_count=0, vendor='', intel_gen='', os='', browser=''):
         self.version = version
         self.path = path
         self.status = status
         self.total_count = total_count
         self.pass_count = pass_count
-        self.gpu = gpu
+        self.vendor = vendor
+        self.intel_gen = intel_gen
         self.os = os
         self.browser = browser
 
     def is_valid(self, gpu, os, browser):
-        return True
+        return Expectations.is_valid_key(self.get_key(), gpu, os, browser)
+
+    def get_key(self):
+        return (self.vendor, self.intel_gen, self.os, self.browser)
 
 
+# Expectations are read from a file with one expectation per line:
+#   <version> <path> <status> [<total count> <pass count>] [vendor=<name>] [intel_gen=<gen>] [os=<name>] [browser=<name>]
+# version may be *, and a path ending with / applies to all cases in the dir.
+# Expectations are indexed by (vendor, intel_gen, os, browser), with '' for any,
+# so only the groups matching the environment are merged, the more specific
+# ones winning, into a dict of path -> Expectation.
 class Expectations(object):
-    def __init__(self):
-        self.expectations = []
+    CONDITIONS = ['vendor', 'intel_gen', 'os', 'browser']
 
-        # win_os = OS('windows')
-        # self._add_exp('2.0.1', 'deqp/functional/gles3/builtinprecision/atan2.html', Status.FAIL, 25, 17, os=win_os)
+    def __init__(self, path=None, version=None):
+        # (vendor, intel_gen, os, browser) -> {path: Expectation}
+        self.index = {}
+        if path:
+            self._load(path, version)
+
+    # Return path -> Expectation valid for the environment.
+    def compile(self, gpu, os, browser):
+        keys = [key for key in self.index if self.is_valid_key(key, gpu, os, browser)]
+        keys.sort(key=lambda x: len([condition for condition in x if condition]))
+        expectations = {}
+        for key in keys:
+            expectations.update(self.index[key])
+        return expectations
+
+    # Expectation of the case itself, or else of the closest dir of it
+    @staticmethod
+    def lookup(expectations, case_path):
+        if case_path in expectations:
+            return expectations[case_path]
+        index = len(case_path)
+        while True:
+            index = case_path.rfind('/', 0, index)
+            if index < 0:
+                return None
+            exp = expectations.get(case_path[:index + 1])
+            if exp:
+                return exp
+
+    @staticmethod
+    def is_valid_key(key, gpu, os, browser):
+        (vendor, intel_gen, os_name, browser_name) = key
+        if vendor and not gpu._is_vendor_name(vendor):
+            return False
+        if intel_gen and gpu.intel_gen != intel_gen:
+            return False
+        if os_name and os.name != os_name:
+            return False
+        if browser_name and browser.name != browser_name:
+            return False
+        return True
+
+    def _add_exp(self, version, path, status, total_count=0, pass_count=0, vendor='', intel_gen='', os='', browser=''):
+        exp = Expectation(version, path, status, total_count, pass_count, vendor, intel_gen, os, browser)
+        self.index.setdefault(exp.get_key(), {})[path] = exp
+
+    def _load(self, path, version):
+        if not os.path.exists(path):
+            Util.error('Could not find expectations %s' % path)
+
+        for (line_num, line) in enumerate(Util.read_file(path)):
+            location = '%s:%s' % (path, line_num + 1)
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) < 3:
+                Util.error('Expectation at %s should have version, path and status' % location)
+            (exp_version, exp_path, status) = fields[:3]
+            if exp_version != '*' and exp_version != version:
+                continue
+            if status not in [Status.PASS, Status.FAIL, Status.CRASH, Status.FILTER, Status.PYTIMEOUT, Status.JSTIMEOUT]:
+                Util.error('Unknown status %s at %s' % (status, location))
+
+            counts = []
+            conditions = {}
+            for field in fields[3:]:
+                if '=' in field:
+                    (name, value) = field.split('=', 1)
+                    if name not in self.CONDITIONS:
+                        Util.error('Unknown condition %s at %s' % (name, location))
+                    if name == 'vendor' and value not in GPU.VENDOR_NAMES:
+                        Util.error('Unknown vendor %s at %s' % (value, location))
+                    conditions[name] = value
+                elif field.isdigit():
+                    counts.append(int(field))
+                else:
+                    Util.error('Unknown field %s at %s' % (field, location))
+            if len(counts) not in [0, 2]:
+                Util.error('Expectation at %s should have both total count and pass count' % location)
 
-    def _add_exp(self, version, path, status, total_count=0, pass_count=0, gpu=None, os=None, browser=None):
-        self.expectations.append(Expectation(version, path, status, total_count, pass_count, gpu, os, browser))
+            self._add_exp(exp_version, exp_path, status, *counts, **conditions)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,370 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from conformance import Browser, Case, Change, Comparison, Coordinator, Expectations, FlakeHistory, GPU, OS, ResultCache, ResumeJournal, Shard, Status, Suite, WorkerClient
+# imported by another name, or pytest would take it as a class of tests
+from conformance import TestList as CaseList
+
+SDK_TESTS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sdk', 'tests'))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.tmp_dir, 'cache.db'), SDK_TESTS_DIR, 'fingerprint')
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_deps(self, case_path):
+        deps = self.cache._get_deps(os.path.normpath(os.path.join(SDK_TESTS_DIR, case_path)))
+        return set(os.path.relpath(dep, SDK_TESTS_DIR).replace(os.sep, '/') for dep in deps)
+
+    # Modules required with goog.require() are found through deqp-deps.js,
+    # whose paths are relative to closure base.js rather than to deqp-deps.js.
+    def test_deqp_deps(self):
+        deps = self._get_deps('deqp/functional/gles3/fbocolorbuffer/clear.html')
+        self.assertIn('deqp/deqp-deps.js', deps)
+        self.assertIn('deqp/functional/gles3/es3fFboColorbufferTests.js', deps)
+        # required by es3fFboColorbufferTests, not by the page itself
+        self.assertIn('deqp/framework/common/tcuTexture.js', deps)
+        self.assertIn('deqp/framework/delibs/debase/deMath.js', deps)
+
+    def test_key_changes_with_deqp_framework(self):
+        case_path = 'deqp/functional/gles3/fbocolorbuffer/clear.html'
+        key = self.cache.get_key(case_path)
+        self.cache.file_hashes[os.path.normpath(os.path.join(SDK_TESTS_DIR, 'deqp/framework/delibs/debase/deMath.js'))] = 'changed'
+        self.assertNotEqual(key, self.cache.get_key(case_path))
+
+
+class SuiteTest(unittest.TestCase):
+    # A case of a later run replaces the one of an earlier run, and keeps its index.
+    def test_merge(self):
+        suite = Suite()
+        suite.merge([Case('a.html', Status.FAIL, 2, 1), Case('b.html', Status.PASS, 1, 1)])
+        suite.merge([Case('a.html', Status.PASS, 2, 2), Case('c.html', Status.CRASH, 1, 0)])
+        self.assertEqual([case.path for case in suite.suite], ['a.html', 'b.html', 'c.html'])
+        self.assertEqual(suite.get_case(0).status, Status.PASS)
+        self.assertEqual(suite.issue_path, set(['c.html']))
+
+
+class ComparisonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_csv(self, name, rows):
+        path = os.path.join(self.tmp_dir, name)
+        f = open(path, 'w')
+        f.write('path,cur_status,cur_total,cur_pass,time\n')
+        for row in rows:
+            f.write('%s,%s,%s,%s,0\n' % row)
+        f.close()
+        return path
+
+    def test_read_merged(self):
+        first = self._write_csv('first.csv', [('b.html', Status.FAIL, 2, 1), ('a.html', Status.PASS, 1, 1)])
+        second = self._write_csv('second.csv', [('c.html', Status.PASS, 1, 1), ('b.html', Status.PASS, 2, 2)])
+        cases = list(Comparison(None).read('%s+%s' % (first, second)))
+        self.assertEqual([(case.path, case.status) for case in cases], [('a.html', Status.PASS), ('b.html', Status.PASS), ('c.html', Status.PASS)])
+
+    # A case missing on either side takes NOTEXIST there, and is categorized
+    # like a removed or new case in the report of a run.
+    def test_join_missing(self):
+        exp_cases = [
+            Case('a.html', Status.FAIL, 2, 1),
+            Case('b.html', Status.FILTER),
+            Case('c.html', Status.PASS, 1, 1),
+            Case('e.html', Status.FAIL, 2, 1),
+        ]
+        cur_cases = [
+            Case('d.html', Status.FAIL, 2, 1),
+            Case('e.html', Status.FAIL, 2, 0),
+            Case('f.html', Status.PASS, 1, 1),
+        ]
+        changes = list(Comparison.join(iter(exp_cases), iter(cur_cases)))
+        self.assertEqual([(change.exp_case.path, change.exp_case.status, change.cur_case.status, change.category) for change in changes], [
+            ('a.html', Status.FAIL, Status.NOTEXIST, Change.IMPROVE_PASS),
+            ('b.html', Status.FILTER, Status.NOTEXIST, Change.REMAIN),
+            ('c.html', Status.PASS, Status.NOTEXIST, Change.PASS),
+            ('d.html', Status.NOTEXIST, Status.FAIL, Change.REGRESS),
+            ('e.html', Status.FAIL, Status.FAIL, Change.REGRESS),
+            ('f.html', Status.NOTEXIST, Status.PASS, Change.PASS),
+        ])
+
+    def test_join_empty(self):
+        self.assertEqual(list(Comparison.join(iter([]), iter([]))), [])
+        changes = list(Comparison.join(iter([]), iter([Case('a.html', Status.PASS, 1, 1)])))
+        self.assertEqual([change.category for change in changes], [Change.PASS])
+
+
+class FlakeHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = FlakeHistory(os.path.join(self.tmp_dir, 'history.db'))
+        self.history.add('a.html', 3, 3, 2, 1)
+        self.history.save()
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_quarantined(self):
+        return [row[0] for row in self.history.get_quarantined(0.5, set(['a.html']))]
+
+    # A quarantined case is retried again after QUARANTINE_RUNS runs.
+    def test_quarantine_expires(self):
+        for i in range(FlakeHistory.QUARANTINE_RUNS):
+            self.assertEqual(self._get_quarantined(), ['a.html'])
+        self.assertEqual(self._get_quarantined(), [])
+        self.assertEqual(self._get_quarantined(), ['a.html'])
+
+    def test_clean_runs_lower_score(self):
+        self.history.add_clean('a.html')
+        self.history.add_clean('a.html')
+        self.history.add_clean('b.html')
+        self.history.save()
+        self.assertEqual(self._get_quarantined(), ['a.html'])
+        self.history.add_clean('a.html')
+        self.history.add_clean('a.html')
+        self.history.save()
+        self.assertEqual(self._get_quarantined(), [])
+        self.assertEqual(self.history.conn.execute('SELECT COUNT(*) FROM flake').fetchone()[0], 1)
+
+
+class TestListTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._write('00_test_list.txt', [
+            '# comment',
+            '// comment',
+            '; comment',
+            'abc',
+            'a/00_test_list.txt',
+            '--min-version 1.0.3 b/00_test_list.txt',
+        ])
+        self._write('a/00_test_list.txt', [
+            'one.html',
+            '--slow two.html',
+            '--min-version 1.0.4 three.html',
+            '--max-version 1.0.2 four.html',
+            '--min-version 2.0.0 five.html',
+        ])
+        self._write('b/00_test_list.txt', [
+            'six.html',
+            # an option of the case wins over the one of its list
+            '--min-version 1.0.2 seven.html',
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, path, lines):
+        path = os.path.join(self.tmp_dir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+
+    # Cases are selected as getFileList() of webgl-test-harness.js does.
+    def test_version(self):
+        self.assertEqual(CaseList(self.tmp_dir, '1.0.3').get_paths(), ['a/one.html', 'a/two.html', 'b/six.html', 'b/seven.html'])
+        self.assertEqual(CaseList(self.tmp_dir, '1.0.2').get_paths(), ['a/one.html', 'a/two.html', 'a/four.html', 'b/seven.html'])
+        self.assertEqual(CaseList(self.tmp_dir, '2.0.1').get_paths(), ['a/one.html', 'a/two.html', 'a/three.html', 'a/five.html', 'b/six.html', 'b/seven.html'])
+
+    def test_min_max_version(self):
+        self.assertEqual(CaseList(self.tmp_dir, '2.0.1', min_version='1.0.4').get_paths(), ['a/three.html', 'a/five.html'])
+        # only cases with a max version are compared with it
+        self.assertEqual(CaseList(self.tmp_dir, '2.0.1', max_version='1.0.1').get_paths(), ['a/one.html', 'a/two.html', 'a/three.html', 'a/five.html', 'b/six.html', 'b/seven.html'])
+
+    def test_suite(self):
+        test_list = CaseList(self.tmp_dir, '1.0.3')
+        self.assertEqual(test_list.get_paths('all'), test_list.get_paths())
+        self.assertEqual(test_list.get_paths('a'), ['a/one.html', 'a/two.html'])
+        self.assertEqual(test_list.get_paths('all/b/six.html'), ['b/six.html'])
+
+    def test_sdk(self):
+        paths = CaseList(SDK_TESTS_DIR, '1.0.3').get_paths()
+        self.assertIn('conformance/attribs/gl-bindAttribLocation-aliasing.html', paths)
+        self.assertFalse([path for path in paths if path.startswith(('conformance2/', 'conformance/offscreencanvas/'))])
+        paths = CaseList(SDK_TESTS_DIR, '2.0.1').get_paths()
+        self.assertTrue([path for path in paths if path.startswith('conformance2/')])
+
+
+class ExpectationsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'expectations.txt')
+        f = open(self.path, 'w')
+        f.write('\n'.join([
+            '# version path status [total pass] [conditions]',
+            '* conformance/a/ FAIL',
+            '2.0.1 conformance/a/one.html FAIL 10 8  # comment',
+            '2.0.1 conformance/a/one.html PASS vendor=intel',
+            '2.0.1 conformance/a/one.html CRASH vendor=intel os=linux',
+            '2.0.1 conformance/b/two.html FILTER browser=firefox',
+            '1.0.3 conformance/b/three.html FAIL',
+        ]) + '\n')
+        f.close()
+        self.expectations = Expectations(self.path, '2.0.1')
+        self.linux = OS('linux')
+        self.chrome = Browser('chrome', '/bin/true', [], self.linux)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _lookup(self, gpu, os, browser, case_path):
+        exp = Expectations.lookup(self.expectations.compile(gpu, os, browser), case_path)
+        if exp:
+            return (exp.status, exp.total_count, exp.pass_count)
+        return None
+
+    # More specific expectations win, and a dir applies to the cases in it.
+    def test_lookup(self):
+        nvidia = GPU('nvidia', '', '', '', '')
+        intel = GPU('intel', '', '', '', '')
+        self.assertEqual(self._lookup(nvidia, self.linux, self.chrome, 'conformance/a/one.html'), (Status.FAIL, 10, 8))
+        self.assertEqual(self._lookup(intel, OS('win'), self.chrome, 'conformance/a/one.html'), (Status.PASS, 0, 0))
+        self.assertEqual(self._lookup(intel, self.linux, self.chrome, 'conformance/a/one.html'), (Status.CRASH, 0, 0))
+        self.assertEqual(self._lookup(nvidia, self.linux, self.chrome, 'conformance/a/c/four.html'), (Status.FAIL, 0, 0))
+        self.assertEqual(self._lookup(nvidia, self.linux, self.chrome, 'conformance/b/two.html'), None)
+        self.assertEqual(self._lookup(nvidia, self.linux, Browser('firefox', '/bin/true', [], self.linux), 'conformance/b/two.html'), (Status.FILTER, 0, 0))
+        # of another version
+        self.assertEqual(self._lookup(nvidia, self.linux, self.chrome, 'conformance/b/three.html'), None)
+
+    def _load_error(self, line):
+        f = open(self.path, 'w')
+        f.write(line + '\n')
+        f.close()
+        self.assertRaises(SystemExit, Expectations, self.path, '2.0.1')
+
+    def test_errors(self):
+        self._load_error('2.0.1 conformance/a.html')
+        self._load_error('2.0.1 conformance/a.html BROKEN')
+        self._load_error('2.0.1 conformance/a.html FAIL 10')
+        self._load_error('2.0.1 conformance/a.html FAIL vendor=apple')
+        self._load_error('2.0.1 conformance/a.html FAIL gpu=intel')
+        self._load_error('2.0.1 conformance/a.html FAIL many')
+
+
+class ResumeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'resume.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    # Cases of a batch not committed yet are lost when the run is interrupted,
+    # and the run is resumed with the committed ones.
+    def test_resume_interrupted_batch(self):
+        journal = ResumeJournal(self.path)
+        self.assertEqual(journal.open_run('suite', None, 'run1'), [])
+        count = ResumeJournal.BATCH_SIZE + 5
+        for index in range(count):
+            journal.add(Case('case-%s.html' % index, Status.PASS, 1, 1))
+        # interrupted without commit
+        journal.conn.close()
+
+        journal = ResumeJournal(self.path)
+        cases = journal.open_run('suite', None, 'run2')
+        self.assertEqual(journal.run_id, 'run1')
+        self.assertEqual(sorted(case.path for case in cases), sorted('case-%s.html' % index for index in range(ResumeJournal.BATCH_SIZE)))
+        # cases run again replace the ones already there
+        journal.add(Case('case-0.html', Status.FAIL, 1, 0))
+        journal.finish_run()
+        journal.close()
+
+        journal = ResumeJournal(self.path)
+        self.assertEqual(journal.open_run('suite', None, 'run3'), [])
+        self.assertEqual(journal.run_id, 'run3')
+        self.assertEqual(journal.conn.execute("SELECT status FROM result WHERE run_id = 'run1' AND path = 'case-0.html'").fetchone()[0], Status.FAIL)
+        journal.close()
+
+    def test_other_suite(self):
+        journal = ResumeJournal(self.path)
+        journal.open_run('suite', None, 'run1')
+        journal.add(Case('a.html', Status.PASS, 1, 1))
+        journal.close()
+        journal = ResumeJournal(self.path)
+        self.assertEqual(journal.open_run('other', None, 'run2'), [])
+        self.assertRaises(SystemExit, journal.open_run, 'other', 'run1', 'run3')
+        journal.close()
+
+
+class CoordinatorTest(unittest.TestCase):
+    ENV = {
+        'gpu': ['intel', '8086', 'GPU', '1234', '1.0'],
+        'target_os': {'name': 'linux', 'version': '1'},
+        'browser': {'name': 'chrome', 'version': '100'},
+    }
+
+    def setUp(self):
+        self.results = []
+        self.coordinator = Coordinator(0, ['a.html', 'b.html', 'c.html'], '2.0.1', self._register, self._skip, self._add, token='secret')
+        self.coordinator.mode = 'firstrun'
+        self.coordinator.total_count = 3
+
+    def tearDown(self):
+        self.coordinator.server.shutdown()
+        self.coordinator.server.server_close()
+
+    def _register(self, worker_id):
+        return Shard(worker_id, None)
+
+    def _skip(self, shard, mode, index, case_index, total_count):
+        return (False, None)
+
+    def _add(self, shard, mode, index, case_index, total_count, case, cache_key):
+        self.results.append((shard.id, case_index, case.status))
+
+    def _post(self, path, request):
+        return self.coordinator.handle(path, request)
+
+    # Items of a worker not heard from are given to another worker, and its
+    # late results are refused.
+    def test_dead_worker(self):
+        self.coordinator.items.extend([(0, 0), (1, 1), (2, 2)])
+        worker0 = self._post('/register', {'env': self.ENV, 'version': '2.0.1'})[1]['worker_id']
+        worker1 = self._post('/register', {'env': self.ENV, 'version': '2.0.1'})[1]['worker_id']
+        items = self._post('/batch', {'worker_id': worker0})[1]['items']
+        self.assertEqual([item[3] for item in items], [0])
+        items += self._post('/batch', {'worker_id': worker0})[1]['items']
+        self.assertEqual([item[3] for item in items], [0, 1])
+
+        self.coordinator.last_seen[worker0] = time.time() - Coordinator.WORKER_TIMEOUT - 1
+        with self.coordinator.condition:
+            self.coordinator._check_workers()
+        self.assertEqual(list(self.coordinator.items), [(0, 0), (1, 1), (2, 2)])
+        self.assertEqual(self._post('/result', {'worker_id': worker0, 'item_id': items[0][0], 'case': ['a.html', Status.PASS, 1, 1, 0]})[0], 410)
+
+        items = self._post('/batch', {'worker_id': worker1})[1]['items']
+        self.assertEqual([item[3] for item in items], [0])
+        self._post('/result', {'worker_id': worker1, 'item_id': items[0][0], 'case': ['a.html', Status.PASS, 1, 1, 0]})
+        self.assertEqual(self.results, [(worker1, 0, Status.PASS)])
+        self.assertEqual(self.coordinator.outstanding, {})
+
+    def test_token(self):
+        url = 'http://127.0.0.1:%s' % self.coordinator.port
+        self.assertRaises(SystemExit, WorkerClient(url, 'wrong').register, self.ENV, '2.0.1')
+        self.assertEqual(self.coordinator.workers, {})
+        worker = WorkerClient(url, 'secret')
+        self.assertEqual(worker.register(self.ENV, '2.0.1'), ['a.html', 'b.html', 'c.html'])
+        worker.close()
+
+    def test_register_other_env(self):
+        self._post('/register', {'env': self.ENV, 'version': '2.0.1'})
+        env = dict(self.ENV, browser={'name': 'firefox', 'version': '100'})
+        self.assertEqual(self._post('/register', {'env': env, 'version': '2.0.1'})[0], 409)
+        self.assertEqual(self._post('/register', {'env': self.ENV, 'version': '1.0.3'})[0], 409)
+
+
+if __name__ == '__main__':
+    unittest.main()